@@ -2,10 +2,18 @@ from torch.utils.data import Dataset
 import torch
 import h5pickle as h5py
 
+def rating_label(rating, classes=2):
+    # positive (4 or 5 stars) against the rest, or the rating itself from 0
+    if classes == 2:
+        return (rating > 3) * 1
+    return rating - 1
+
 class DatasetAmazon(Dataset):
-    def __init__(self, path):
+    def __init__(self, path, classes=2):
+        self.path = path
         self.f = h5py.File(path,'r')
         self.keyname = list(self.f.keys())
+        self.classes = classes
         
     def __len__(self):
         return len(self.keyname)
@@ -13,6 +21,33 @@ class DatasetAmazon(Dataset):
     def __getitem__(self, index):
         line = self.f[self.keyname[index]][:]
         text = line[:-1] # up to the last one is text
-        label = line[-1:]
-        label = (label > 3) * 1
-        return torch.LongTensor(text), torch.LongTensor(label)
\ No newline at end of file
+        label = rating_label(line[-1:], self.classes)
+        return torch.LongTensor(text), torch.LongTensor(label)
+
+class DatasetSynthetic(Dataset):
+    # random reviews in the same format as DatasetAmazon for runs without the
+    # preprocessed data: padded word ids followed by a 1-5 rating, where the
+    # rating makes a small group of words more likely so the task is learnable
+    def __init__(self, size, n_vocab=10000, text_size=100, seed=0, classes=2):
+        self.classes = classes
+        self.seed = seed
+        g = torch.Generator()
+        g.manual_seed(seed)
+        ratings = torch.randint(1, 6, (size, 1), generator=g)
+        lengths = torch.randint(5, text_size + 1, (size, 1), generator=g)
+        # 1: padding, 2: unknown, as in reducer.tokenize
+        text = torch.randint(3, n_vocab, (size, text_size), generator=g)
+        words = 3 + (ratings - 1)*50 + torch.randint(0, 50, (size, text_size), generator=g)
+        signal = torch.rand(size, text_size, generator=g) < 0.5
+        text = torch.where(signal, words, text)
+        text[torch.arange(text_size).unsqueeze(0) >= lengths] = 1
+        self.lines = torch.cat([text, ratings], 1)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, index):
+        line = self.lines[index]
+        text = line[:-1]
+        label = rating_label(line[-1:], self.classes)
+        return text, label
@@ -0,0 +1,192 @@
+"""
+Offline simulator for the load balancing in dynamic_dataloader.py
+
+Models a synchronous data parallel job where one step on rank r with a batch
+of b samples takes (overhead + b * cost) milliseconds, scaled by a random
+jitter and by any slowdown active at that point of the run. The simulator
+drives DynamicDistributedSampler and a split policy through many epochs on
+the CPU and reports the epoch makespan, the idle time of every rank and the
+samples dropped by the equal iteration restriction.
+
+    python balance_sim.py --costs 1,1,2,4 --overhead 5 --epochs 20
+    python balance_sim.py --costs 1,1,1,1 --slowdown 2:3:0.5:4 --policy all
+
+Policies are looked up in SPLIT_POLICIES or given as module:function and
+have the same signature as the ones in dynamic_dataloader.py.
+"""
+
+import argparse
+import importlib
+import numpy as np
+from dynamic_dataloader import DynamicDistributedSampler, SPLIT_POLICIES
+from dynamic_dataloader import get_batch_data_split
+
+
+def static_split(sampler, time_arr, total_batch):
+    # baseline that never moves away from the uniform split
+    perc_arr = np.ones(sampler.world_size)/sampler.world_size
+    return get_batch_data_split(perc_arr, total_batch, sampler.total_size)
+
+
+def load_policy(name):
+    if name == 'static':
+        return static_split
+    if name in SPLIT_POLICIES:
+        return SPLIT_POLICIES[name]
+    module, _, function = name.partition(':')
+    return getattr(importlib.import_module(module), function)
+
+
+class SimulatedRank(object):
+    def __init__(self, cost, overhead=0., jitter=0.):
+        # cost in ms per sample, overhead in ms per step
+        self.cost = cost
+        self.overhead = overhead
+        self.jitter = jitter
+        self.slowdowns = []
+
+    def add_slowdown(self, epoch, start, factor):
+        # slow the rank down by factor from the given fraction
+        # of the given epoch until the end of the run
+        self.slowdowns.append((epoch, start, factor))
+
+    def factor(self, epoch, progress):
+        factor = 1.
+        for start_epoch, start, slow in self.slowdowns:
+            if (epoch, progress) >= (start_epoch, start):
+                factor *= slow
+        return factor
+
+    def step_time(self, batch_size, epoch, progress, rng):
+        step = self.overhead + batch_size*self.cost
+        if self.jitter > 0:
+            step *= max(rng.normal(1., self.jitter), 0.)
+        return step*self.factor(epoch, progress)/1000.
+
+
+def simulate_epoch(ranks, samplers, batch_sizes, drop_last, epoch, rng):
+    world_size = len(ranks)
+    steps = []
+    for sampler, batch_size in zip(samplers, batch_sizes):
+        if batch_size <= 0:
+            # the DataLoader refuses a batch size of zero
+            steps.append(0)
+        elif drop_last:
+            steps.append(len(sampler)//batch_size)
+        else:
+            steps.append(-(-len(sampler)//batch_size))
+    busy = np.zeros(world_size)
+    consumed = set()
+    makespan = 0.
+    for r in range(world_size):
+        indices = list(iter(samplers[r]))
+        consumed.update(indices[:steps[r]*batch_sizes[r]])
+    for k in range(max(steps)):
+        step_times = np.zeros(world_size)
+        for r in range(world_size):
+            if k >= steps[r]:
+                continue
+            samples = min(batch_sizes[r], len(samplers[r]) - k*batch_sizes[r])
+            step_times[r] = ranks[r].step_time(samples, epoch, k/steps[r], rng)
+        busy += step_times
+        # every step waits for the slowest rank in the allreduce
+        makespan += step_times.max()
+    return {
+        'epoch': epoch,
+        'makespan': makespan,
+        'busy': busy,
+        'idle': makespan - busy,
+        'steps': steps,
+        'batch_sizes': list(batch_sizes),
+        'dropped': len(samplers[0].dataset) - len(consumed),
+        'zero_batch': int(np.sum(np.asarray(batch_sizes) <= 0)),
+    }
+
+
+def simulate(ranks, total_data, total_batch, epochs, policy, seed=0):
+    world_size = len(ranks)
+    rng = np.random.RandomState(seed)
+    dataset = range(total_data)
+    samplers = [DynamicDistributedSampler(dataset, num_replicas=world_size, rank=r)
+                for r in range(world_size)]
+    # the initial loader in get_dataloader splits the batch
+    # uniformly and drops the last incomplete batch
+    batch_sizes = [total_batch//world_size]*world_size
+    drop_last = True
+    results = []
+    for epoch in range(1, epochs + 1):
+        for sampler in samplers:
+            sampler.set_epoch(epoch)
+        result = simulate_epoch(ranks, samplers, batch_sizes, drop_last, epoch, rng)
+        result['predicted'] = samplers[0].predicted_time
+        results.append(result)
+        time_arr = np.maximum(result['busy'], 1e-9)
+        for sampler in samplers:
+            batch_size_split, data_split = policy(sampler, time_arr.copy(), total_batch)
+            sampler.set_split(data_split, batch_size_split)
+        batch_sizes = [int(b) for b in batch_size_split]
+        drop_last = False
+    return results
+
+
+def report(name, results):
+    print("policy: {}".format(name))
+    print("{:>5} {:>10} {:>10} {:>8} {:>8}  {}".format(
+        'epoch', 'makespan', 'predicted', 'dropped', 'zero_bs', 'idle per rank (s)'))
+    for result in results:
+        predicted = result['predicted']
+        print("{:>5} {:>10.3f} {:>10} {:>8} {:>8}  {}".format(
+            result['epoch'], result['makespan'],
+            '-' if predicted is None else '{:.3f}'.format(predicted),
+            result['dropped'], result['zero_batch'],
+            ' '.join('{:.3f}'.format(idle) for idle in result['idle'])))
+    makespan = sum(result['makespan'] for result in results)
+    idle = sum(result['idle'].sum() for result in results)
+    world_size = len(results[0]['idle'])
+    print("total makespan: {:.3f}s, idle fraction: {:.2%}, dropped samples: {}".format(
+        makespan, idle/(makespan*world_size), sum(result['dropped'] for result in results)))
+    print("---")
+
+
+def parse_floats(text, world_size=None):
+    values = [float(v) for v in text.split(',')]
+    if world_size is not None and len(values) == 1:
+        values = values*world_size
+    return values
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--costs", type=str, default='1,1,2,4',
+                        help="per-sample cost of every rank in ms")
+    parser.add_argument("--overhead", type=str, default='0',
+                        help="fixed per-step overhead in ms, one value or one per rank")
+    parser.add_argument("--jitter", type=float, default=0.05,
+                        help="standard deviation of the multiplicative step jitter")
+    parser.add_argument("--slowdown", type=str, action='append', default=[],
+                        help="rank:epoch:fraction:factor, may be repeated")
+    parser.add_argument("--data", type=int, default=100000)
+    parser.add_argument("--batch", type=int, default=32,
+                        help="batch size per rank, as in dynamic_rnn.py")
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--policy", type=str, default='proportional',
+                        help="static, a name in SPLIT_POLICIES, module:function or all")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    costs = parse_floats(args.costs)
+    world_size = len(costs)
+    overheads = parse_floats(args.overhead, world_size)
+    if args.policy == 'all':
+        names = ['static'] + list(SPLIT_POLICIES)
+    else:
+        names = args.policy.split(',')
+
+    for name in names:
+        ranks = [SimulatedRank(c, o, args.jitter) for c, o in zip(costs, overheads)]
+        for slowdown in args.slowdown:
+            rank, epoch, start, factor = slowdown.split(':')
+            ranks[int(rank)].add_slowdown(int(epoch), float(start), float(factor))
+        results = simulate(ranks, args.data, args.batch*world_size, args.epochs,
+                           load_policy(name), args.seed)
+        report(name, results)
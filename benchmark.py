@@ -0,0 +1,373 @@
+"""
+CPU benchmarks for the distributed sentiment RNN on synthetic data
+
+Every benchmark spawns gloo processes on this machine, trains through the
+same Trainer as dynamic_rnn.py and prints one line per configuration.
+
+    python benchmark.py scaling --procs 1,2,4 --threads 1
+    python benchmark.py packed --procs 1
+    python benchmark.py amp --procs 2
+    python benchmark.py accum --procs 2 --warmup 20 --target 0.95
+    python benchmark.py sparse --procs 2
+    python benchmark.py compress --procs 2
+    python benchmark.py local_sgd --procs 1,2,4 --local_sgd 8
+    python benchmark.py hogwild --procs 1,2,4
+    python benchmark.py param_server --procs 3 --servers 1 --straggler 0:3
+    python benchmark.py models --procs 1 --hidden_size 64
+    python benchmark.py distill --procs 2 --students bag,cnn --temperature 2
+"""
+
+import os
+import sys
+import copy
+import argparse
+import tempfile
+from contextlib import redirect_stdout
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel.distributed import DistributedDataParallel
+from dynamic_rnn import Trainer, get_dataloader, get_dataset, get_datasets, get_optimizer
+from dynamic_rnn import get_warmup_scheduler, get_loss, slow_down
+from distill import DistillationLoss, load_teacher, cached_logits
+from checkpoint import AsyncCheckpointer
+from models import MODELS, get_model
+from export_model import latency
+from compression import register_compression, HOOKS
+from local_sgd import LocalSGD
+import hogwild as hogwild_trainer
+import param_server as param_server_trainer
+
+
+def launch(worker, world_size, args, port=29600):
+    # run worker(rank, world_size, args) on world_size gloo processes
+    # and return what rank 0 returned
+    ctx = mp.get_context('spawn')
+    queue = ctx.SimpleQueue()
+    mp.spawn(_bootstrap, args=(worker, world_size, args, port, queue), nprocs=world_size)
+    return queue.get()
+
+
+def _bootstrap(rank, worker, world_size, args, port, queue):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.manual_seed(args.seed)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    # keep the per-rank training logs out of the report
+    with open(os.devnull, 'w') as devnull:
+        with redirect_stdout(devnull if not args.verbose else sys.stdout):
+            result = worker(rank, world_size, args)
+    if rank == 0:
+        queue.put(result)
+    dist.destroy_process_group()
+
+
+def build_synthetic(args):
+    return get_model(args.model, args.n_vocab, args.sequence, args.sparse, args.classes,
+                     embedding_size=args.embedding_size, hidden_size=args.hidden_size,
+                     num_layers=args.num_layers)
+
+
+def train_synthetic(rank, world_size, args):
+    loss = get_loss(args.classes)
+    teacher, logits = None, None
+    if args.teacher:
+        teacher = load_teacher(args.teacher, torch.device('cpu'), args.classes)
+        loss = DistillationLoss(loss, args.distill_alpha, args.temperature)
+        if args.teacher_cache:
+            logits = cached_logits(teacher, args.teacher, args.teacher_cache,
+                                   get_dataset(None, args.data, args.classes), torch.device('cpu'))
+            teacher = None
+    train_loader, test_loader = get_dataloader(None, args.batch, synthetic=args.data,
+                                               classes=args.classes, logits=logits)
+    model = build_synthetic(args)
+    if args.straggler:
+        straggler, factor = args.straggler.split(':')
+        if int(straggler) == rank:
+            slow_down(model, float(factor))
+    compression = None
+    if args.local_sgd == 0:
+        model = DistributedDataParallel(model)
+        compression = register_compression(model, args.compression, args.topk_ratio)
+    # linear learning rate scaling with the accumulated batch
+    optimizer = get_optimizer(model, args.lr*args.accum)
+    scheduler = get_warmup_scheduler(optimizer, args.warmup)
+    local_sgd = None
+    if args.local_sgd > 0:
+        local_sgd = LocalSGD(model, optimizer, args.local_sgd, args.local_sgd_momentum,
+                             args.local_sgd_adaptive)
+    checkpointer = None
+    if args.checkpoint:
+        config = dict(model=args.model, n_vocab=args.n_vocab, sequence=args.sequence,
+                      sparse=args.sparse, classes=args.classes, embedding_size=args.embedding_size,
+                      hidden_size=args.hidden_size, num_layers=args.num_layers)
+        checkpointer = AsyncCheckpointer(args.checkpoint, metadata={'model_config': config})
+    trainer = Trainer(model, optimizer, train_loader, test_loader, loss, amp=args.amp,
+                      accum=args.accum, scheduler=scheduler, compression=compression,
+                      local_sgd=local_sgd, classes=args.classes, checkpointer=checkpointer,
+                      teacher=teacher)
+    return trainer.fit(args.epochs)
+
+
+def mean_throughput(history):
+    # the first epoch runs with the uniform split
+    return sum(h['throughput'] for h in history[1:] or history)/max(len(history) - 1, 1)
+
+
+def scaling(args):
+    print("{:>6} {:>14} {:>10} {:>10}".format('procs', 'samples/s', 'speedup', 'test acc'))
+    base = None
+    for procs in args.procs:
+        history = launch(train_synthetic, procs, args)
+        throughput = mean_throughput(history)
+        base = base or throughput
+        print("{:>6} {:>14.1f} {:>10.2f} {:>9.2f}%".format(
+            procs, throughput, throughput/base, history[-1]['test_acc']*100))
+
+
+def with_options(args, **options):
+    args = copy.copy(args)
+    for name, value in options.items():
+        setattr(args, name, value)
+    return args
+
+
+def compare(args, configs):
+    # train every named config on the first process count and
+    # report the steps/sec and accuracy of the final epoch
+    procs = args.procs[0]
+    print("{:>12} {:>10} {:>14} {:>10}".format('config', 'steps/s', 'samples/s', 'test acc'))
+    results = {}
+    for name, options in configs:
+        history = launch(train_synthetic, procs, with_options(args, **options))
+        last = history[-1]
+        results[name] = history
+        print("{:>12} {:>10.2f} {:>14.1f} {:>9.2f}%".format(
+            name, last['throughput']/(args.batch*procs), last['throughput'], last['test_acc']*100))
+    return results
+
+
+def packed(args):
+    compare(args, [(sequence, {'sequence': sequence})
+                   for sequence in ['padded', 'packed', 'trimmed']])
+
+
+def amp(args):
+    compare(args, [('fp32', {'amp': 'off'}), ('bf16', {'amp': 'bf16'})])
+
+
+def inference_throughput(model, test_set, batch_size=256):
+    # reviews/s of the forward pass on batches of test reviews in this process
+    return batch_size/latency(model.eval(), test_set, batch_size)
+
+
+def models(args):
+    # training throughput and accuracy of every model next to its
+    # inference throughput on batches of 256 test reviews
+    procs = args.procs[0]
+    _, test_set = get_datasets(None, args.data, args.classes)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    print("{:>6} {:>10} {:>15} {:>16} {:>10}".format(
+        'model', 'params', 'train samples/s', 'infer reviews/s', 'test acc'))
+    for name in sorted(MODELS):
+        options = with_options(args, model=name)
+        history = launch(train_synthetic, procs, options)
+        model = build_synthetic(options)
+        params = sum(p.numel() for p in model.parameters())
+        print("{:>6} {:>10} {:>15.1f} {:>16.1f} {:>9.2f}%".format(
+            name, params, mean_throughput(history), inference_throughput(model, test_set),
+            history[-1]['test_acc']*100))
+
+
+def distill(args):
+    # an LSTM teacher, then every student trained on the labels alone,
+    # with the teacher scoring every batch and with its cached logits
+    procs = args.procs[0]
+    _, test_set = get_datasets(None, args.data, args.classes)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    print("{:>6} {:>9} {:>15} {:>16} {:>10}".format(
+        'model', 'targets', 'train samples/s', 'infer reviews/s', 'test acc'))
+    with tempfile.TemporaryDirectory() as directory:
+        teacher = os.path.join(directory, 'teacher.pt')
+        cache = os.path.join(directory, 'logits.pt')
+        runs = [('lstm', 'labels', with_options(args, model='lstm', checkpoint=teacher))]
+        for student in args.students.split(','):
+            runs += [(student, 'labels', with_options(args, model=student)),
+                     (student, 'teacher', with_options(args, model=student, teacher=teacher)),
+                     (student, 'cached', with_options(args, model=student, teacher=teacher,
+                                                      teacher_cache=cache))]
+        for name, targets, options in runs:
+            history = launch(train_synthetic, procs, options)
+            print("{:>6} {:>9} {:>15.1f} {:>16.1f} {:>9.2f}%".format(
+                name, targets, mean_throughput(history),
+                inference_throughput(build_synthetic(options), test_set), history[-1]['test_acc']*100))
+
+
+def time_to_accuracy(history, target):
+    elapsed = 0.
+    for h in history:
+        elapsed += h['epoch_time']
+        if h['test_acc'] >= target:
+            return elapsed
+    return None
+
+
+def accum(args):
+    procs = args.procs[0]
+    print("{:>6} {:>16} {:>14} {:>16} {:>10}".format(
+        'accum', 'allreduce/epoch', 'samples/s', 'time to {:.0%}'.format(args.target), 'test acc'))
+    for k in [1, 4, 8]:
+        history = launch(train_synthetic, procs, with_options(args, accum=k))
+        reached = time_to_accuracy(history, args.target)
+        print("{:>6} {:>16} {:>14.1f} {:>16} {:>9.2f}%".format(
+            k, history[-1]['optimizer_steps'], history[-1]['throughput'],
+            '-' if reached is None else '{:.1f}s'.format(reached), history[-1]['test_acc']*100))
+
+
+def sparse(args):
+    procs = args.procs[0]
+    # bytes one rank sends per optimizer step
+    print("{:>8} {:>16} {:>12} {:>10}".format('gradient', 'sent bytes/step', 'ms/step', 'test acc'))
+    for name, options in [('dense', {'sparse': False}), ('sparse', {'sparse': True})]:
+        history = launch(train_synthetic, procs, with_options(args, **options))
+        last = history[-1]
+        print("{:>8} {:>16.0f} {:>12.2f} {:>9.2f}%".format(
+            name, last['comm_bytes']/last['optimizer_steps'],
+            1000.*args.batch*procs/last['throughput'], last['test_acc']*100))
+
+
+def compress(args):
+    procs = args.procs[0]
+    print("{:>9} {:>16} {:>12} {:>10}".format('scheme', 'sent bytes/step', 'ms/step', 'test acc'))
+    for scheme in ['none'] + sorted(HOOKS):
+        history = launch(train_synthetic, procs, with_options(args, compression=scheme))
+        last = history[-1]
+        print("{:>9} {:>16.0f} {:>12.2f} {:>9.2f}%".format(
+            scheme, last['comm_bytes']/last['optimizer_steps'],
+            1000.*args.batch*procs/last['throughput'], last['test_acc']*100))
+
+
+def local_sgd(args):
+    # scaling curve of a gradient allreduce every step against
+    # averaging the models every --local_sgd steps
+    period = args.local_sgd or 8
+    print("{:>12} {:>6} {:>14} {:>10} {:>14} {:>10}".format(
+        'sync', 'procs', 'samples/s', 'speedup', 'bytes/epoch', 'test acc'))
+    configs = [('ddp', {'local_sgd': 0}),
+               ('local_sgd', {'local_sgd': period, 'local_sgd_momentum': False}),
+               ('local_sgd+m', {'local_sgd': period, 'local_sgd_momentum': True})]
+    for name, options in configs:
+        base = None
+        for procs in args.procs:
+            history = launch(train_synthetic, procs, with_options(args, **options))
+            throughput = mean_throughput(history)
+            base = base or throughput
+            print("{:>12} {:>6} {:>14.1f} {:>10.2f} {:>14.0f} {:>9.2f}%".format(
+                name, procs, throughput, throughput/base, history[-1]['comm_bytes'],
+                history[-1]['test_acc']*100))
+
+
+def hogwild(args):
+    # lock-free updates of one shared model against synchronous DDP
+    train_set, test_set = get_datasets(None, args.data)
+    print("{:>8} {:>6} {:>14} {:>10} {:>10}".format(
+        'sync', 'procs', 'samples/s', 'speedup', 'test acc'))
+    for name in ['ddp', 'hogwild']:
+        base = None
+        for procs in args.procs:
+            if name == 'ddp':
+                history = launch(train_synthetic, procs, args)
+            else:
+                with open(os.devnull, 'w') as devnull:
+                    with redirect_stdout(devnull if not args.verbose else sys.stdout):
+                        history = hogwild_trainer.run(train_set, test_set, procs, args)
+            throughput = mean_throughput(history)
+            base = base or throughput
+            print("{:>8} {:>6} {:>14.1f} {:>10.2f} {:>9.2f}%".format(
+                name, procs, throughput, throughput/base, history[-1]['test_acc']*100))
+
+
+def param_server(args):
+    # throughput with the injected --straggler of DDP, which rebalances
+    # between epochs, against the asynchronous parameter server
+    procs = args.procs[0]
+    train_set, test_set = get_datasets(None, args.data)
+    print("{:>13} {:>14} {:>10} {:>10}".format('mode', 'samples/s', 'dropped', 'test acc'))
+    history = launch(train_synthetic, procs, args)
+    print("{:>13} {:>14.1f} {:>10} {:>9.2f}%".format(
+        'ddp', mean_throughput(history), '-', history[-1]['test_acc']*100))
+    history = param_server_trainer.run(train_set, test_set,
+                                       with_options(args, procs=procs, quiet=not args.verbose))
+    print("{:>13} {:>14.1f} {:>10} {:>9.2f}%".format(
+        'param_server', mean_throughput(history), history[-1]['dropped'],
+        history[-1]['test_acc']*100))
+
+
+BENCHMARKS = {
+    'scaling': scaling,
+    'packed': packed,
+    'amp': amp,
+    'accum': accum,
+    'sparse': sparse,
+    'compress': compress,
+    'local_sgd': local_sgd,
+    'hogwild': hogwild,
+    'param_server': param_server,
+    'models': models,
+    'distill': distill,
+}
+
+
+def parse_ints(text):
+    return [int(v) for v in text.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--procs", type=parse_ints, default=[1, 2, 4])
+    parser.add_argument("--threads", type=int, default=1, help="intra-op threads per process")
+    parser.add_argument("--data", type=int, default=20000, help="synthetic reviews")
+    parser.add_argument("--batch", type=int, default=32)
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--lr", type=float, default=0.05)
+    parser.add_argument("--n_vocab", type=int, default=10000)
+    # the padded model barely learns the synthetic task in a few epochs
+    parser.add_argument("--sequence", type=str, default='trimmed',
+                        choices=['padded', 'packed', 'trimmed'])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--model", type=str, default='lstm', choices=sorted(MODELS))
+    parser.add_argument("--embedding_size", type=int, default=None)
+    parser.add_argument("--hidden_size", type=int, default=None)
+    parser.add_argument("--num_layers", type=int, default=None)
+    parser.add_argument("--classes", type=int, default=2, choices=[2, 5])
+    parser.add_argument("--amp", type=str, default='off', choices=['off', 'bf16'])
+    parser.add_argument("--accum", type=int, default=1)
+    parser.add_argument("--sparse", action='store_true')
+    parser.add_argument("--compression", type=str, default='none')
+    parser.add_argument("--topk_ratio", type=float, default=0.01)
+    parser.add_argument("--local_sgd", type=int, default=0,
+                        help="optimizer steps between model averages, 0 for DDP")
+    parser.add_argument("--local_sgd_momentum", action='store_true')
+    parser.add_argument("--local_sgd_adaptive", action='store_true')
+    parser.add_argument("--straggler", type=str, default=None,
+                        help="rank:factor, slow the forward pass of one rank down")
+    parser.add_argument("--servers", type=int, default=1, help="parameter server processes")
+    parser.add_argument("--staleness", type=int, default=8,
+                        help="shard versions a parameter server gradient may lag behind")
+    parser.add_argument("--port", type=int, default=29650, help="parameter server rpc port")
+    parser.add_argument("--warmup", type=int, default=0, help="warmup optimizer steps")
+    parser.add_argument("--target", type=float, default=0.95, help="test accuracy to reach")
+    parser.add_argument("--verbose", action='store_true', help="show the training logs")
+    parser.add_argument("--students", type=str, default='bag,cnn', help="models to distill the LSTM into")
+    parser.add_argument("--distill_alpha", type=float, default=0.5,
+                        help="weight of the teacher's soft targets against the labels")
+    parser.add_argument("--temperature", type=float, default=2.)
+    # set by the distill benchmark for the runs it makes
+    parser.set_defaults(checkpoint=None, teacher=None, teacher_cache=None)
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
@@ -0,0 +1,133 @@
+"""
+Startup capacity calibration for the dynamic split
+
+Before the first epoch every rank times a few synthetic forward/backward
+steps of a fresh copy of the model at several batch sizes, on reviews
+padded to the lengths of a sample of the training set, fits the same
+(overhead per step, cost per sample) model the cost_model policy uses and
+all-gathers the result, so epoch 1 already runs with a balanced split.
+Only the forward pass is fitted, as that is what Trainer balances on.
+
+Results are cached per host, device and model in a JSON file so that
+reruns on the same machines skip the measurement.
+"""
+
+import os
+import json
+import time
+import socket
+import platform
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+from dynamic_dataloader import collective_device, fit_cost_model
+from models import PAD
+
+
+def device_name(device):
+    if device.type == 'cuda':
+        return torch.cuda.get_device_name(device)
+    return '{} x{}'.format(platform.processor() or platform.machine(), torch.get_num_threads())
+
+
+def cache_key(model, device, batch_sizes, lengths):
+    params = sum(p.numel() for p in model.parameters())
+    # trimmed and packed models run for as long as the reviews are
+    return '{}|{}|{}|{}|{}|{}|{:.0f}'.format(socket.gethostname(), device_name(device),
+                                            type(model).__name__, params,
+                                            ','.join(str(b) for b in batch_sizes),
+                                            getattr(model, 'sequence', ''), np.mean(lengths))
+
+
+def review_lengths(dataset, count=1024, seed=0):
+    # the number of words of a sample of the reviews of dataset
+    g = torch.Generator().manual_seed(seed)
+    indices = torch.randint(len(dataset), (min(count, len(dataset)),), generator=g).tolist()
+    return [max(int(dataset[i][0].ne(PAD).sum()), 1) for i in indices]
+
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def time_model(model, device, lengths, batch_sizes=(8, 32, 128), steps=5, text_size=100):
+    # rows of (steps, samples, forward time) for every batch size, on
+    # reviews with lengths drawn from lengths and padded up to text_size
+    n_vocab = model.word_embeddings.num_embeddings
+    optimizer = torch.optim.SGD(model.parameters(), 0.)
+    # one logit for the binary label, one per class otherwise
+    loss_fn = nn.BCEWithLogitsLoss() if model.classes == 2 else nn.CrossEntropyLoss()
+    model.train()
+    g = torch.Generator().manual_seed(0)
+    lengths = torch.tensor(lengths)
+    rows = []
+    for batch_size in batch_sizes:
+        text = torch.randint(3, n_vocab, (batch_size, text_size), generator=g)
+        length = lengths[torch.randint(len(lengths), (batch_size, 1), generator=g)]
+        text[torch.arange(text_size).unsqueeze(0) >= length] = PAD
+        text = text.to(device)
+        label = torch.randint(0, model.classes, (batch_size,), generator=g).to(device)
+        if model.classes == 2:
+            label = label.view(-1, 1).float()
+        forward_time = 0.
+        # the first step warms up the allocator and kernels
+        for step in range(steps + 1):
+            _sync(device)
+            start = time.time()
+            output = model(text)
+            _sync(device)
+            if step > 0:
+                forward_time += time.time() - start
+            loss = loss_fn(output, label)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+        rows.append((steps, steps*batch_size, forward_time))
+    return rows
+
+
+def load_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_cache(path, cache):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=1)
+    os.replace(tmp, path)
+
+
+def calibrate(model_fn, device, lengths, cache_path=None, batch_sizes=(8, 32, 128), steps=5):
+    # returns the (overheads, costs) of all ranks, lengths is
+    # review_lengths of the training set
+    model = model_fn().to(device)
+    key = cache_key(model, device, batch_sizes, lengths)
+    cache = load_cache(cache_path) if cache_path else {}
+    if key in cache:
+        overhead, cost = cache[key]
+        print("Calibration cached for", key)
+    else:
+        calibration_start = time.time()
+        overhead, cost = fit_cost_model(None, time_model(model, device, lengths, batch_sizes, steps))
+        print("Calibration Time", time.time() - calibration_start)
+        if cache_path:
+            cache = load_cache(cache_path)
+            cache[key] = [float(overhead), float(cost)]
+            save_cache(cache_path, cache)
+    del model
+    collective = collective_device()
+    world_size = dist.get_world_size()
+    result = [torch.zeros(2, dtype=torch.float64, device=collective) for _ in range(world_size)]
+    dist.all_gather(result, torch.tensor([overhead, cost], dtype=torch.float64, device=collective))
+    result = torch.stack(result).cpu().numpy()
+    print("Calibrated overheads", result[:, 0], "costs", result[:, 1])
+    return result[:, 0], np.maximum(result[:, 1], 1e-12)
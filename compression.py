@@ -0,0 +1,123 @@
+"""
+Gradient compression for the DistributedDataParallel allreduce
+
+Communication hooks that replace the fp32 allreduce of every gradient bucket:
+
+    fp16, bf16  cast the bucket before the allreduce
+    topk        exchange only the largest entries of every bucket
+    powersgd    low-rank approximation from torch's PowerSGD hook
+
+All schemes keep the compression error of every bucket as a residual and add
+it back before the next compression (error feedback), so what one step
+drops is sent later instead of being lost. The state counts the bytes this
+rank put on the wire.
+"""
+
+import torch
+import torch.distributed as dist
+from torch.distributed.algorithms.ddp_comm_hooks import powerSGD_hook
+
+
+class CompressionState(object):
+    def __init__(self, scheme, process_group=None, ratio=0.01, rank=1):
+        self.scheme = scheme
+        self.process_group = process_group
+        self.world_size = dist.get_world_size(process_group)
+        # fraction of every bucket topk sends
+        self.ratio = ratio
+        self.residuals = {}
+        self.bytes = 0
+        if scheme == 'powersgd':
+            # PowerSGD keeps its own error feedback, it only starts
+            # compressing after a couple of plain allreduces
+            self.powersgd = powerSGD_hook.PowerSGDState(
+                process_group=process_group, matrix_approximation_rank=rank,
+                start_powerSGD_iter=2, use_error_feedback=True, warm_start=True)
+
+    def add_residual(self, bucket):
+        buffer = bucket.buffer()
+        residual = self.residuals.get(bucket.index())
+        if residual is not None and residual.shape == buffer.shape:
+            buffer.add_(residual)
+        return buffer
+
+
+def cast_hook(dtype):
+    def hook(state, bucket):
+        buffer = state.add_residual(bucket)
+        compressed = buffer.to(dtype)
+        state.residuals[bucket.index()] = buffer - compressed.to(buffer.dtype)
+        compressed.div_(state.world_size)
+        state.bytes += compressed.numel()*compressed.element_size()
+        future = dist.all_reduce(compressed, group=state.process_group, async_op=True).get_future()
+
+        def decompress(future):
+            buffer.copy_(future.value()[0])
+            return buffer
+        return future.then(decompress)
+    return hook
+
+
+def topk_hook(state, bucket):
+    buffer = state.add_residual(bucket)
+    k = max(1, int(buffer.numel()*state.ratio))
+    _, indices = buffer.abs().topk(k, sorted=False)
+    values = buffer[indices]
+    residual = buffer.clone()
+    residual[indices] = 0
+    state.residuals[bucket.index()] = residual
+    state.bytes += k*(values.element_size() + indices.element_size())
+    # every rank picks different entries, so gather all of them
+    all_values = [torch.empty_like(values) for _ in range(state.world_size)]
+    all_indices = [torch.empty_like(indices) for _ in range(state.world_size)]
+    futures = [
+        dist.all_gather(all_values, values, group=state.process_group, async_op=True).get_future(),
+        dist.all_gather(all_indices, indices, group=state.process_group, async_op=True).get_future(),
+    ]
+
+    def decompress(future):
+        buffer.zero_()
+        for rank_values, rank_indices in zip(all_values, all_indices):
+            buffer.index_add_(0, rank_indices, rank_values)
+        buffer.div_(state.world_size)
+        return buffer
+    return torch.futures.collect_all(futures).then(decompress)
+
+
+def powersgd_bytes(state, bucket):
+    # what PowerSGD sends for the bucket: P and Q for the matrices it
+    # compresses, the plain tensor for everything else
+    if state.powersgd.iter < state.powersgd.start_powerSGD_iter:
+        return bucket.buffer().numel()*bucket.buffer().element_size()
+    total = 0
+    rank = state.powersgd.matrix_approximation_rank
+    for tensor in bucket.gradients():
+        if tensor.ndimension() > 1:
+            n, m = tensor.shape[0], tensor.numel()//tensor.shape[0]
+            if (n + m)*min(n, m, rank) < n*m:
+                total += (n + m)*min(n, m, rank)*tensor.element_size()
+                continue
+        total += tensor.numel()*tensor.element_size()
+    return total
+
+
+def powersgd_hook(state, bucket):
+    state.bytes += powersgd_bytes(state, bucket)
+    return powerSGD_hook.powerSGD_hook(state.powersgd, bucket)
+
+
+HOOKS = {
+    'fp16': cast_hook(torch.float16),
+    'bf16': cast_hook(torch.bfloat16),
+    'topk': topk_hook,
+    'powersgd': powersgd_hook,
+}
+
+
+def register_compression(model, scheme, ratio=0.01, rank=1):
+    # returns the state counting the bytes sent, or None for plain fp32
+    if scheme == 'none':
+        return None
+    state = CompressionState(scheme, ratio=ratio, rank=rank)
+    model.register_comm_hook(state, HOOKS[scheme])
+    return state
@@ -0,0 +1,132 @@
+"""
+Knowledge distillation of a trained model into a cheaper one
+
+A student, typically the bag of embeddings or the CNN of models.py, trains
+through the same Trainer as dynamic_rnn.py on a blend of the usual loss on
+the labels and a soft loss on the logits of a teacher, both softened by a
+temperature T:
+
+    loss = (1 - alpha)*hard + alpha*T*T*soft
+
+soft is the binary cross entropy against sigmoid(teacher/T) for the binary
+label and the KL divergence from softmax(teacher/T) for the star ratings.
+The T*T keeps its gradients on the scale of the hard loss.
+
+    torchrun --nproc_per_node 4 dynamic_rnn.py --model bag --teacher lstm.pt \\
+        --distill_alpha 0.5 --temperature 2 --teacher_cache data.h5.teacher.pt
+
+The teacher is any checkpoint of dynamic_rnn.py --checkpoint, or an
+export of export_model.py. With
+--teacher_cache its logits are computed once for the whole dataset,
+sharded over the ranks, and saved next to the data; later runs reuse them
+as long as the teacher checkpoint and the data are unchanged, and
+every review comes out of the dataset with the logits of the teacher.
+Without a cache the teacher scores every training batch on the fly, at
+the cost of its forward pass on every step.
+"""
+
+import os
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.distributed as dist
+from torch.utils.data import Dataset, DataLoader, Subset
+from models import load_model
+from checkpoint import load_checkpoint, save_atomic
+from dynamic_dataloader import collective_device
+
+
+def load_teacher(path, device, classes=2):
+    teacher = load_model(path, device)
+    # checked before any logits are computed or cached
+    if teacher.classes != classes:
+        raise ValueError("the teacher {} has {} classes, the student {}".format(
+            path, teacher.classes, classes))
+    return teacher
+
+
+class WithLogits(Dataset):
+    # the reviews of dataset along with the cached logits of the teacher
+    def __init__(self, dataset, logits):
+        if len(dataset) != len(logits):
+            raise ValueError("{} teacher logits for {} reviews".format(len(logits), len(dataset)))
+        self.dataset = dataset
+        self.logits = logits
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        text, label = self.dataset[index]
+        return text, label, self.logits[index]
+
+
+def teacher_logits(teacher, dataset, device, batch_size=256):
+    # every rank scores a contiguous shard and all of them gather the rest
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    shard = math.ceil(len(dataset)/world_size)
+    indices = range(rank*shard, min(len(dataset), (rank + 1)*shard))
+    outputs = 1 if teacher.classes == 2 else teacher.classes
+    logits = torch.zeros(shard, outputs)
+    k = 0
+    with torch.no_grad():
+        for text, _ in DataLoader(Subset(dataset, indices), batch_size=batch_size):
+            output = teacher(text.to(device))
+            logits[k:k + len(output)] = output.float().cpu()
+            k += len(output)
+    logits = logits.to(collective_device())
+    shards = [torch.zeros_like(logits) for _ in range(world_size)]
+    dist.all_gather(shards, logits)
+    return torch.cat(shards)[:len(dataset)].cpu()
+
+
+def data_key(dataset):
+    # the reviews the logits are of, the h5 file or the synthetic seed
+    path = getattr(dataset, 'path', None)
+    if path is not None:
+        return {'data': os.path.abspath(path), 'data_mtime': os.path.getmtime(path)}
+    return {'data': 'synthetic', 'seed': dataset.seed}
+
+
+def cached_logits(teacher, teacher_path, cache, dataset, device):
+    # the logits of cache if they belong to this teacher and dataset,
+    # computed and saved again otherwise
+    key = dict(data_key(dataset), teacher=os.path.abspath(teacher_path),
+               mtime=os.path.getmtime(teacher_path), size=len(dataset))
+    state = load_checkpoint(cache)
+    valid = state is not None and state['key'] == key
+    # the ranks compute them together, so they all have to agree
+    flag = torch.tensor([int(valid)], device=collective_device())
+    dist.all_reduce(flag, op=dist.ReduceOp.MIN)
+    if flag.item():
+        return state['logits']
+    logits = teacher_logits(teacher, dataset, device)
+    if dist.get_rank() == 0:
+        save_atomic({'key': key, 'logits': logits}, cache)
+    dist.barrier()
+    return logits
+
+
+class DistillationLoss(nn.Module):
+    def __init__(self, hard, alpha=0.5, temperature=2.):
+        super().__init__()
+        # the loss on the labels, get_loss of dynamic_rnn.py
+        self.hard = hard
+        self.alpha = alpha
+        self.temperature = temperature
+
+    def forward(self, output, label, teacher=None):
+        # only the loss on the labels without the teacher's
+        # logits, as Trainer evaluates the student
+        hard = self.hard(output, label)
+        if teacher is None:
+            return hard
+        t = self.temperature
+        output, teacher = output.float()/t, teacher.float()/t
+        if output.size(1) == 1:
+            soft = F.binary_cross_entropy_with_logits(output, torch.sigmoid(teacher))
+        else:
+            soft = F.kl_div(F.log_softmax(output, 1), F.log_softmax(teacher, 1),
+                            reduction='batchmean', log_target=True)
+        return (1 - self.alpha)*hard + self.alpha*t*t*soft
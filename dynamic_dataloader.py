@@ -1,5 +1,6 @@
 import math
 import time
+import heapq
 import numpy as np
 import torch
 from torch.utils import data
@@ -12,6 +13,12 @@ def undo_cumulative_sum(arr):
     res[1:] -= res[:-1]
     return res
 
+def collective_device():
+    # nccl only moves cuda tensors, gloo works on host memory
+    if dist.get_backend() == 'nccl':
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
 def get_batch_data_split(perc_arr, total_batch, total_data):
     cum = perc_arr.cumsum()
     cum[-1] = 1.
@@ -26,49 +33,278 @@ def get_batch_data_split(perc_arr, total_batch, total_data):
     sampler_split = np.insert(iter_size*batch_split,0,0).astype(int)
     return batch_size_split, sampler_split
 
-def get_dynamic_loader(loader, time_taken, total_batch):
-    overhead = time.time()
-    sampler = loader.sampler
-    total_data = sampler.total_size
-    local_rank = sampler.rank
-    world_size = sampler.world_size
-    time_list = [torch.zeros(1).cuda() for _ in range(world_size)]
-    dist.all_gather(time_list, torch.tensor(time_taken).cuda())
+def pin_split(perc_arr, pinned, total_batch):
+    # one sample per step for the pinned ranks, the others
+    # share the rest in their proportions
+    if pinned is None or not pinned.any():
+        return perc_arr
+    perc_arr = perc_arr.copy()
+    perc_arr[pinned] = 1./total_batch
+    kept = ~pinned
+    perc_arr[kept] *= (1. - perc_arr[pinned].sum())/perc_arr[kept].sum()
+    return perc_arr
+
+def proportional_split(sampler, time_arr, total_batch):
     # normalize by the previous workload
     # to get the normalized time taken
-    time_arr = torch.tensor(time_list).cpu().data.numpy()/sampler.perc_split
+    time_arr = time_arr/sampler.perc_split
     inv = 1./time_arr
-    perc_arr = inv/inv.sum()
+    perc_arr = pin_split(inv/inv.sum(), sampler.pinned, total_batch)
     sampler.perc_split = perc_arr
-    batch_size_split, data_split = get_batch_data_split(perc_arr, total_batch, total_data)
+    return get_batch_data_split(perc_arr, total_batch, sampler.total_size)
+
+def fit_cost_model(model, history, tolerance=0.1, min_spread=1.25):
+    # model is the (overhead per step, cost per sample) of one rank or None
+    # and history its rows of (steps, samples, time) since it last changed speed
+    steps, samples, taken = history[-1]
+    if model is not None:
+        predicted = model[0]*steps + model[1]*samples
+        if abs(predicted - taken) > tolerance*taken:
+            # the rank changed speed, forget the older epochs
+            # and rescale the whole step to the latest one
+            del history[:-1]
+            return model[0]*taken/predicted, model[1]*taken/predicted
+    rows = np.asarray(history, dtype=float)
+    A, times = rows[:, :2], rows[:, 2]
+    # the overhead is only identifiable once the batch size has changed
+    # enough for timing noise not to dominate the fit
+    batch = A[:, 1]/A[:, 0]
+    if batch.max() >= min_spread*batch.min():
+        (overhead, cost), _, _, _ = np.linalg.lstsq(A, times, rcond=None)
+        if overhead >= 0 and cost > 0:
+            return overhead, cost
+    if model is not None:
+        ratio = times.sum()/A.dot(model).sum()
+        return model[0]*ratio, model[1]*ratio
+    return 0., taken/samples
+
+def solve_batch_split(overheads, costs, total_batch, pinned=None):
+    # hand out the global batch one sample at a time to the rank whose
+    # step would finish first, which minimizes the step makespan
+    # max(overhead + cost*batch) with at least one sample per rank,
+    # pinned ranks keep just the one
+    batch = np.ones(len(costs), dtype=int)
+    heap = [(overheads[r] + costs[r]*2, r) for r in range(len(costs))
+            if pinned is None or not pinned[r]]
+    heapq.heapify(heap)
+    for _ in range(total_batch - len(costs)):
+        _, r = heapq.heappop(heap)
+        batch[r] += 1
+        heapq.heappush(heap, (overheads[r] + costs[r]*(batch[r] + 1), r))
+    return batch
+
+def get_cost_model_split(overheads, costs, total_batch, total_data, pinned=None):
+    overheads, costs = np.asarray(overheads), np.asarray(costs)
+    batch_size_split = solve_batch_split(overheads, costs, total_batch, pinned)
+    total_batch = batch_size_split.sum()
+    # every rank runs the same number of steps and together they cover
+    # every sample, the last step is shortened on the slowest ranks
+    iter_size = -(-total_data//total_batch)
+    data_split = batch_size_split*iter_size
+    excess = data_split.sum() - total_data
+    for r in np.argsort(-(overheads + costs*batch_size_split)):
+        trim = min(excess, batch_size_split[r] - 1)
+        data_split[r] -= trim
+        excess -= trim
+    # whatever is left wraps around to the start of the permutation
+    step_time = overheads + costs*batch_size_split
+    predicted = iter_size*step_time.max()
+    return batch_size_split, np.insert(data_split.cumsum(), 0, 0), predicted
+
+def cost_model_split(sampler, time_arr, total_batch, window=4):
+    steps, samples = sampler.workload(total_batch)
+    for r in range(sampler.world_size):
+        history = sampler.cost_history[r]
+        history.append((steps[r], samples[r], time_arr[r]))
+        del history[:-window]
+        sampler.cost_model[r] = fit_cost_model(sampler.cost_model[r], history)
+    overheads, costs = zip(*sampler.cost_model)
+    total_data = len(sampler.dataset)
+    batch_size_split, data_split, predicted = get_cost_model_split(
+        overheads, costs, total_batch, total_data, sampler.pinned)
+    sampler.predicted_time = predicted
+    sampler.perc_split = undo_cumulative_sum(data_split[1:])/data_split[-1]
+    return batch_size_split, data_split
+
+# balancing policies take the sampler, the time taken by every rank
+# in the last epoch and the global batch size, update the sampler state
+# and return the per-rank batch sizes and the cumulative data split
+SPLIT_POLICIES = {
+    'proportional': proportional_split,
+    'cost_model': cost_model_split,
+}
+
+def get_dynamic_loader(loader, time_taken, total_batch, policy=proportional_split):
+    overhead = time.time()
+    sampler = loader.sampler
+    local_rank = sampler.rank
+    world_size = sampler.world_size
+    device = collective_device()
+    time_list = [torch.zeros(1, device=device) for _ in range(world_size)]
+    dist.all_gather(time_list, torch.tensor([float(time_taken)], device=device))
+    time_arr = torch.cat(time_list).cpu().data.numpy()
+    if sampler.predicted_time is not None:
+        print("predicted makespan {:.3f}s, actual {:.3f}s".format(
+            sampler.predicted_time, time_arr.max()))
+    batch_size_split, data_split = policy(sampler, time_arr, total_batch)
     print("new split", data_split)
+    print("dropped samples", sampler.dropped_samples(data_split))
     print("overhead time", time.time()-overhead)
-    sampler.set_split(data_split)
-    new_loader = data.DataLoader(loader.dataset,
-        batch_size = int(batch_size_split[local_rank]),
+    sampler.set_split(data_split, batch_size_split)
+    return rebuild_loader(loader, int(batch_size_split[local_rank]))
+
+def get_calibrated_loader(loader, overheads, costs, total_batch):
+    # seed the split of the first epoch from per-rank (overhead, cost)
+    # measured before training instead of starting uniform
+    sampler = loader.sampler
+    sampler.cost_model = list(zip(overheads, costs))
+    batch_size_split, data_split, predicted = get_cost_model_split(
+        overheads, costs, total_batch, len(sampler.dataset))
+    sampler.predicted_time = predicted
+    sampler.perc_split = undo_cumulative_sum(data_split[1:])/data_split[-1]
+    print("calibrated split", data_split)
+    sampler.set_split(data_split, batch_size_split)
+    return rebuild_loader(loader, int(batch_size_split[sampler.rank]))
+
+def rebuild_loader(loader, batch_size):
+    return data.DataLoader(loader.dataset,
+        batch_size = batch_size,
         shuffle = False,
-        sampler = sampler, num_workers = loader.num_workers)
-    return new_loader
+        sampler = loader.sampler, num_workers = loader.num_workers)
 
 class DynamicDistributedSampler(DistributedSampler):
 
     def __init__(self, *args, **kwargs):
         super(DynamicDistributedSampler, self).__init__(*args, **kwargs)
-        self.world_size = dist.get_world_size()
+        self.world_size = self.num_replicas
         self.split = None
+        self.batch_split = None
         self.perc_split = np.ones(self.world_size)/self.world_size
+        # per-rank (steps, samples, time) history and fitted
+        # (overhead, cost) for the cost model policy
+        self.cost_history = [[] for _ in range(self.world_size)]
+        self.cost_model = [None]*self.world_size
+        self.predicted_time = None
+        # ranks the split policies give one sample per step, None for none
+        self.pinned = None
+        # samples of this rank's share already trained on in this epoch
+        self.start = 0
+        # the samples of an epoch resumed on a different number of ranks
+        # that were still to be trained on, None for the whole dataset
+        self.remaining = None
 
     def __iter__(self):
         # deterministically shuffle based on epoch     
-        if (self.split is None):
-            return super(DynamicDistributedSampler, self).__iter__()
+        if self.remaining is not None:
+            indices = self.remaining[self.split[self.rank]:self.split[self.rank+1]]
+        elif (self.split is None):
+            indices = list(super(DynamicDistributedSampler, self).__iter__())
         else:
             g = torch.Generator()
             g.manual_seed(self.epoch)
             indices = torch.randperm(len(self.dataset), generator=g).tolist()
-            print(self.split[self.rank], self.split[self.rank+1])
+            # pad by wrapping around if the split asks for more than the dataset
+            indices += indices[:max(self.split[-1] - len(indices), 0)]
             indices = indices[self.split[self.rank]:self.split[self.rank+1]]
-            return iter(indices)
-        
-    def set_split(self, split):
-        self.split = split
\ No newline at end of file
+        return iter(indices[self.start:])
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+    def set_split(self, split, batch_split=None):
+        self.split = split
+        self.batch_split = batch_split
+        self.num_samples = int(split[self.rank+1] - split[self.rank])
+
+    def set_start(self, start):
+        # resume the epoch after the first start samples of this rank
+        self.start = start
+
+    def state_dict(self):
+        return {
+            'epoch': self.epoch,
+            'split': self.split,
+            'batch_split': self.batch_split,
+            'perc_split': self.perc_split,
+            'cost_history': self.cost_history,
+            'cost_model': self.cost_model,
+            'predicted_time': self.predicted_time,
+            'remaining': self.remaining,
+        }
+
+    def load_state_dict(self, state):
+        self.epoch = state['epoch']
+        self.perc_split = state['perc_split']
+        self.cost_history = state['cost_history']
+        self.cost_model = state['cost_model']
+        self.predicted_time = state['predicted_time']
+        self.remaining = state.get('remaining')
+        if state['split'] is not None:
+            self.set_split(state['split'], state['batch_split'])
+
+    def resize(self, state, steps, batch_size, total_batch):
+        # continue the epoch of state, interrupted after steps steps on a
+        # different number of ranks: what the old ranks had not reached yet
+        # is split evenly over the current ones, the dynamic split takes
+        # over again from the next epoch. Returns the steps left.
+        world_size = len(state['perc_split'])
+        remaining = []
+        for rank in range(world_size):
+            old = DynamicDistributedSampler(self.dataset, num_replicas=world_size, rank=rank,
+                                            shuffle=self.shuffle, seed=self.seed)
+            old.load_state_dict(state)
+            batch = batch_size if state['batch_split'] is None else int(state['batch_split'][rank])
+            remaining += list(old)[steps*batch:]
+        self.epoch = state['epoch']
+        self.perc_split = np.ones(self.world_size)/self.world_size
+        self.cost_history = [[] for _ in range(self.world_size)]
+        self.cost_model = [None]*self.world_size
+        self.predicted_time = None
+        self.start = 0
+        self.remaining = remaining
+        batch_size_split, split = get_batch_data_split(self.perc_split, total_batch, len(remaining))
+        if split[-1] == 0:
+            # less than a step left, dropped like the last partial batch
+            self.remaining = None
+            batch_size_split, split = get_batch_data_split(self.perc_split, total_batch, self.total_size)
+            self.set_split(split, batch_size_split)
+            return 0
+        self.set_split(split, batch_size_split)
+        return int(split[-1]//total_batch)
+
+    def workload(self, total_batch):
+        # steps and samples every rank ran with the current split,
+        # mirroring the loaders built by get_dataloader and get_dynamic_loader
+        if self.split is None:
+            batch = np.full(self.world_size, total_batch//self.world_size)
+            steps = np.full(self.world_size, self.num_samples//batch[0])
+            return steps, steps*batch
+        samples = undo_cumulative_sum(np.asarray(self.split[1:]))
+        steps = -(-samples//np.asarray(self.batch_split))
+        return steps, samples
+
+    def dropped_samples(self, split):
+        return max(len(self.dataset) - int(split[-1]), 0)
+
+
+class DistributedEvalSampler(Sampler):
+    # every sample exactly once over all ranks, in order, neither padded
+    # nor dropped, in contiguous shares set from the training split
+
+    def __init__(self, dataset, num_replicas=None, rank=None):
+        self.dataset = dataset
+        self.world_size = dist.get_world_size() if num_replicas is None else num_replicas
+        self.rank = dist.get_rank() if rank is None else rank
+        self.set_split(np.ones(self.world_size)/self.world_size)
+
+    def set_split(self, perc_split):
+        bounds = np.round(np.cumsum(perc_split)*len(self.dataset)).astype(int)
+        bounds = np.insert(bounds, 0, 0)
+        bounds[-1] = len(self.dataset)
+        self.start, self.end = int(bounds[self.rank]), int(bounds[self.rank + 1])
+
+    def __iter__(self):
+        return iter(range(self.start, self.end))
+
+    def __len__(self):
+        return self.end - self.start
@@ -2,6 +2,7 @@
 Adapted from PyTorch 1.0 Distributed Trainer with Amazon AWS
 """
 
+import os
 import time
 import sys
 import torch
@@ -12,9 +13,6 @@ import torch.distributed as dist
 import torch.optim
 import torch.utils.data
 import torch.utils.data.distributed
-import torchvision.transforms as transforms
-import torchvision.datasets as datasets
-import torchvision.models as models
 from torch.autograd import Variable
 from torch.multiprocessing import Pool, Process
 from torch.utils.data import random_split
@@ -24,25 +22,55 @@ from torch import nn
 from torch.utils import data
 # from torch.utils.data.distributed import DistributedSampler
 from dynamic_dataloader import DynamicDistributedSampler as DistributedSampler
-from dynamic_dataloader import get_dynamic_loader
+from dynamic_dataloader import get_dynamic_loader, collective_device, SPLIT_POLICIES
+from dynamic_dataloader import get_calibrated_loader, DistributedEvalSampler, rebuild_loader
+from calibration import calibrate, review_lengths
+from compression import register_compression, HOOKS
+from local_sgd import LocalSGD
+from checkpoint import AsyncCheckpointer, load_checkpoint
+from profiler import PhaseTimer, timing_hook
+from telemetry import Telemetry
+from work_stealing import WorkStealingBatchSampler, get_steal_store, gather_idle_time
+from contextlib import nullcontext
 # from dynamic_dataparallel import DistributedDataParallel
 from torch.nn.parallel.distributed import DistributedDataParallel
-from amz_loader import DatasetAmazon
-from sklearn.metrics import f1_score
+from amz_loader import DatasetAmazon, DatasetSynthetic
+from models import MODELS, get_model, predict
+from distill import DistillationLoss, WithLogits, load_teacher, cached_logits
+
+
+def all_reduce_sums(*values):
+    # sum python numbers or tensors of any shape over all ranks in one
+    # allreduce, returns float64 cpu tensors of the same shapes
+    device = collective_device()
+    values = [torch.as_tensor(v, dtype=torch.float64).to(device) for v in values]
+    totals = torch.cat([v.reshape(-1) for v in values])
+    dist.all_reduce(totals)
+    totals = totals.cpu().split([v.numel() for v in values])
+    return [total.view(v.shape) for total, v in zip(totals, values)]
 
 
 class Average(object):
+    # sum is a tensor on the device of the values until it is read,
+    # so updating the meter never waits for the device
     def __init__(self):
         self.sum = 0
         self.count = 0
 
     def update(self, value, number):
+        if torch.is_tensor(value):
+            value = value.detach().double()
         self.sum += value * number
         self.count += number
 
+    def all_reduce(self):
+        total, count = all_reduce_sums(self.sum, self.count)
+        self.sum, self.count = total, int(count)
+        return self
+
     @property
     def average(self):
-        return self.sum / self.count
+        return float(self.sum) / self.count
 
     def __str__(self):
         return '{:.6f}'.format(self.average)
@@ -54,181 +82,524 @@ class Accuracy(object):
         self.count = 0
 
     def update(self, output, label):
-        predictions = torch.sigmoid(output).round().long().data
-        correct = predictions.eq(label.data).sum().item()
+        correct = predict(output).eq(label).sum()
 
         self.correct += correct
         self.count += output.size(0)
 
+    def all_reduce(self):
+        correct, count = all_reduce_sums(self.correct, self.count)
+        self.correct, self.count = int(correct), int(count)
+        return self
+
     @property
     def accuracy(self):
-        return self.correct / self.count
+        return int(self.correct) / self.count
 
     def __str__(self):
         return '{:.2f}%'.format(self.accuracy * 100)
 
 
-class F1_Score(object):
-    def __init__(self):
-        pass
+class ConfusionMatrix(object):
+    # rows are labels and columns predictions, every batch is
+    # counted with a single bincount on the device
+    def __init__(self, classes=2):
+        self.classes = classes
+        self.matrix = torch.zeros(classes, classes, dtype=torch.long)
 
     def update(self, output, label):
-        total = 0
-        for tag in range(5):
-            pos = torch.eq(output, tag).sum().to(dtype = torch.float)
-            tp = torch.eq(label[torch.eq(output, tag)],tag).sum().to(dtype = torch.float)
-            precision = tp / pos
-            fn = torch.eq(label[1-torch.eq(output, tag)],tag).sum().to(dtype = torch.float)
-            recall = tp / torch.add(tp,fn).to(dtype = torch.float)
-            total += 2 * (precision * recall) / (precision + recall)
-        self.f1_score = total / 5
+        index = label.view(-1)*self.classes + predict(output).view(-1)
+        counts = torch.bincount(index, minlength=self.classes**2)
+        self.matrix = self.matrix.to(counts.device) + counts.view(self.classes, self.classes)
+
+    def all_reduce(self):
+        self.matrix = all_reduce_sums(self.matrix)[0].long()
+        return self
+
+    @property
+    def precision(self):
+        matrix = self.matrix.double()
+        return matrix.diag() / matrix.sum(0).clamp(min=1)
+
+    @property
+    def recall(self):
+        matrix = self.matrix.double()
+        return matrix.diag() / matrix.sum(1).clamp(min=1)
+
+    @property
+    def f1(self):
+        precision, recall = self.precision, self.recall
+        return (2 * precision * recall / (precision + recall)).nan_to_num()
 
     @property
     def f1_score(self):
-        return self.f1_score
-    
+        # of the positive class for a binary label, macro averaged otherwise
+        if self.classes == 2:
+            return self.f1[1].item()
+        return self.f1.mean().item()
+
+    @property
+    def accuracy(self):
+        return (self.matrix.diag().sum() / self.matrix.sum().clamp(min=1)).item()
+
     def __str__(self):
-        return '{:.2f}%'.format(self.f1_score)
+        return '{:.2f}% (precision {}, recall {})'.format(
+            self.f1_score * 100,
+            ' '.join('{:.2f}'.format(p) for p in self.precision.tolist()),
+            ' '.join('{:.2f}'.format(r) for r in self.recall.tolist()))
 
 
 class Trainer(object):
-    def __init__(self, net, optimizer, train_loader, test_loader, loss):
+    def __init__(self, net, optimizer, train_loader, test_loader, loss, device=None,
+                 policy='proportional', amp='off', accum=1, scheduler=None, compression=None,
+                 local_sgd=None, classes=2, checkpointer=None, phases=None, telemetry=None,
+                 teacher=None):
         self.net = net
+        # 2 for the positive/negative label, 5 for the star ratings
+        self.classes = classes
+        # how get_dynamic_loader splits the data between ranks
+        self.policy = SPLIT_POLICIES[policy]
+        # default to wherever the model lives
+        self.device = device or next(net.parameters()).device
+        # mixed precision, bf16 needs no loss scaling but fp16 does
+        # and the CPU LSTM kernels only support bf16
+        if amp == 'fp16' and self.device.type != 'cuda':
+            raise ValueError("fp16 autocast needs a cuda device, use bf16 on cpu")
+        self.amp_dtype = {'bf16': torch.bfloat16, 'fp16': torch.float16}.get(amp)
+        self.scaler = torch.amp.GradScaler(self.device.type, enabled=(amp == 'fp16'))
+        # micro-batches accumulated locally per optimizer step
+        self.accum = accum
+        self.scheduler = scheduler
+        self.optimizer_steps = 0
+        self.comm_bytes = 0
+        # state of the gradient compression hook, which counts its own bytes
+        self.compression = compression
+        # periodic model averaging in place of DistributedDataParallel
+        self.local_sgd = local_sgd
         self.optimizer = optimizer
         self.train_loader = train_loader
         self.test_loader = test_loader
         self.loss = loss
         self.timer = 0
-        self.total_batch = train_loader.batch_size*dist.get_world_size()
+        self.stealing = isinstance(train_loader.batch_sampler, WorkStealingBatchSampler)
+        batch_size = train_loader.batch_sampler.batch_size
+        self.total_batch = batch_size*dist.get_world_size()
+        # the loader may already carry a calibrated split
+        batch_split = getattr(train_loader.sampler, 'batch_split', None)
+        if batch_split is not None:
+            self.total_batch = int(sum(batch_split))
+            if isinstance(test_loader.sampler, DistributedEvalSampler):
+                test_loader.sampler.set_split(train_loader.sampler.perc_split)
+        self.history = []
+        # finished epochs and steps into the current one, set by a resume
+        self.epoch = 0
+        self.start_step = 0
+        self.checkpointer = checkpointer
+        # per phase step timing, only the totals unless profiling
+        self.phases = phases or PhaseTimer(device=self.device)
+        # the timing hook can only replace the plain allreduce
+        if self.phases.enabled and compression is None and hasattr(net, 'register_comm_hook'):
+            net.register_comm_hook(self.phases, timing_hook)
+        if self.stealing and (accum > 1 or local_sgd is not None):
+            raise ValueError("gradient accumulation and local SGD need the same number of steps on every rank")
+        # cluster throughput reports and straggler handling
+        self.telemetry = telemetry
+        if telemetry is not None:
+            if self.stealing:
+                raise ValueError("telemetry needs the same number of steps on every rank")
+            self.policy = telemetry.exclude_policy(self.policy)
+        # scores the batches for the distillation loss unless
+        # the dataset comes with the teacher's logits cached
+        self.teacher = teacher
+        # rows of every sparse gradient this rank computed since the
+        # last optimizer step, noted before the allreduce adds the
+        # rows of the other ranks to the gradient
+        self.sparse_rows = {}
+        for m in net.modules():
+            if isinstance(m, (nn.Embedding, nn.EmbeddingBag)) and m.sparse:
+                m.weight.register_hook(self.note_rows(m.weight))
 
     def fit(self, epochs):
-        for epoch in range(1, epochs + 1):
+        for epoch in range(self.epoch + 1, epochs + 1):
             epoch_start = time.time()
+            stalls = len(self.checkpointer.stalls) if self.checkpointer else 0
+            self.phases.start_epoch(epoch)
+            if self.telemetry is not None:
+                self.telemetry.start_epoch(epoch, self.phases)
+            if self.stealing:
+                self.train_loader.batch_sampler.set_epoch(epoch)
             train_loss, train_acc = self.train()
             train_time = time.time() - epoch_start
+            local_samples = train_loss.count
+            if self.phases.enabled and self.phases.profile_dir:
+                self.phases.export(self.phases.profile_dir)
             print("Train Time: ", train_time)
-            test_loss, test_acc = self.evaluate()
+            throughput = self.global_throughput(local_samples, train_time)
+            print("Train Throughput: {:.1f} samples/s on {} processes".format(
+                throughput, dist.get_world_size()))
+            eval_start = time.time()
+            test_loss, test_acc, test_f1 = self.evaluate()
+            eval_time = time.time() - eval_start
+            print("Eval Time: {:.3f}s on {} test samples".format(eval_time, test_loss.count))
+            # the meters were rank local until here
+            for meter in (train_loss, train_acc, test_loss, test_acc, test_f1):
+                meter.all_reduce()
             epoch_time = time.time()-epoch_start
             # updating the batch dynamically
             # self.train_loader.sampler.update_load(self.timer, 100)
             #if (epoch == 1):
             # pass the dynamic_step argument here
-            self.train_loader = get_dynamic_loader(self.train_loader, self.timer, self.total_batch)
+            if not self.stealing:
+                time_taken = self.timer
+                if self.telemetry is not None:
+                    time_taken = self.telemetry.split_time(self.timer, local_samples)
+                self.train_loader = get_dynamic_loader(self.train_loader, time_taken, self.total_batch,
+                                                       self.policy)
+                # faster ranks evaluate a bigger share as well
+                if isinstance(self.test_loader.sampler, DistributedEvalSampler):
+                    self.test_loader.sampler.set_split(self.train_loader.sampler.perc_split)
             print('Epoch: {}/{},'.format(epoch, epochs),
                 'train loss: {}, train acc: {},'.format(train_loss, train_acc),
-                'test loss: {}, test acc: {}.'.format(test_loss, test_acc),
+                'test loss: {}, test acc: {}, test f1: {}.'.format(test_loss, test_acc, test_f1),
                 'epoch time: {}'.format(epoch_time))
+            self.history.append({
+                'epoch': epoch,
+                'train_time': train_time,
+                'epoch_time': epoch_time,
+                'eval_time': eval_time,
+                'throughput': throughput,
+                'optimizer_steps': self.optimizer_steps,
+                'comm_bytes': self.comm_bytes,
+                'train_loss': train_loss.average,
+                'train_acc': train_acc.accuracy,
+                'test_loss': test_loss.average,
+                'test_acc': test_acc.accuracy,
+                'test_f1': test_f1.f1_score,
+                'checkpoint_stall': 0.,
+            })
+            self.epoch = epoch
+            if self.checkpointer is not None:
+                self.checkpoint(0)
+                self.history[-1]['checkpoint_stall'] = sum(self.checkpointer.stalls[stalls:])
+                print("Checkpoint stall {:.3f}s over {} checkpoints".format(
+                    self.history[-1]['checkpoint_stall'], len(self.checkpointer.stalls) - stalls))
+        if self.checkpointer is not None:
+            self.checkpointer.wait()
+        return self.history
+
+    def checkpoint(self, step):
+        # the model and optimizer are the same on every rank
+        if dist.get_rank() == 0:
+            self.checkpointer.save(self.state_dict(step))
+
+    def state_dict(self, step=0):
+        sampler = self.train_loader.sampler
+        return {
+            'model': getattr(self.net, 'module', self.net).state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'scheduler': self.scheduler.state_dict() if self.scheduler is not None else None,
+            'scaler': self.scaler.state_dict(),
+            'epoch': self.epoch,
+            'step': step,
+            'sampler': sampler.state_dict() if hasattr(sampler, 'state_dict') else None,
+            'history': self.history,
+            'world_size': dist.get_world_size(),
+        }
+
+    def load_state_dict(self, state):
+        getattr(self.net, 'module', self.net).load_state_dict(state['model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        if self.scheduler is not None and state['scheduler'] is not None:
+            self.scheduler.load_state_dict(state['scheduler'])
+        self.scaler.load_state_dict(state['scaler'])
+        self.epoch = state['epoch']
+        self.history = state['history']
+        sampler = self.train_loader.sampler
+        if state['sampler'] is None or not hasattr(sampler, 'load_state_dict'):
+            return
+        if state.get('world_size', dist.get_world_size()) != dist.get_world_size():
+            # ranks joined or left since the checkpoint
+            steps = sampler.resize(state['sampler'], state['step'], self.train_loader.batch_size,
+                                   self.total_batch)
+            self.train_loader = rebuild_loader(self.train_loader, int(sampler.batch_split[sampler.rank]))
+            if isinstance(self.test_loader.sampler, DistributedEvalSampler):
+                self.test_loader.sampler.set_split(sampler.perc_split)
+            if steps == 0:
+                self.epoch += 1
+            print("Resized from {} to {} ranks, {} steps left in the epoch".format(
+                state['world_size'], dist.get_world_size(), steps))
+            return
+        # continue with the balanced split, after the samples
+        # every rank already trained on in the interrupted epoch
+        sampler.load_state_dict(state['sampler'])
+        if sampler.batch_split is not None:
+            self.train_loader = rebuild_loader(self.train_loader, int(sampler.batch_split[sampler.rank]))
+            self.total_batch = int(sum(sampler.batch_split))
+            if isinstance(self.test_loader.sampler, DistributedEvalSampler):
+                self.test_loader.sampler.set_split(sampler.perc_split)
+        self.start_step = state['step']
+        sampler.set_start(self.start_step*self.train_loader.batch_size)
+
+    def global_throughput(self, samples, seconds):
+        # samples of all ranks over the time of the slowest one
+        device = collective_device()
+        samples = torch.tensor([float(samples)], device=device)
+        seconds = torch.tensor([float(seconds)], device=device)
+        dist.all_reduce(samples)
+        dist.all_reduce(seconds, op=dist.ReduceOp.MAX)
+        return samples.item()/seconds.item()
 
     def train(self):
         train_loss = Average()
         train_acc = Accuracy()
         
-        begin_time = time.time()
-
-        print("Self.net.train: ", time.time()-begin_time)
-        forward_timer = 0
-        loss_timer = 0
-        backward_timer = 0
-        opti_timer = 0
-        update_timer = 0
-        total_timer = 0
-        load_timer = 0
-        count = 0
-        load_start = time.time()
+        phases = self.phases
         self.net.train()
         i = 0
-        for data, label in self.train_loader:
-            load_timer += time.time()-load_start
-            #start_time = time.time()
-            data = data.cuda(non_blocking=True)
-            label = label.cuda(non_blocking=True)
-            # forward is called here
-            forward_start = time.time()
-            output = self.net(data)
-            forward_timer += time.time()-forward_start
-
-            loss_start = time.time()
-            loss = self.loss(output, label.float())
-            
+        # with work stealing the ranks run out of chunks at different steps
+        join = self.net.join() if self.stealing else nullcontext()
+        optimizer_steps = 0
+        comm_bytes = 0
+        # hooks and model averaging count the bytes they send themselves
+        counter = self.compression or self.local_sgd
+        counted_start = counter.bytes if counter else 0
+        step_samples = 0
+        with join:
+            num_batches = len(self.train_loader)
             self.optimizer.zero_grad()
-            
-            backward_start = time.time()
-            loss_timer += backward_start - loss_start
-            loss.backward()
-            
-            opti_start = time.time()
-            backward_timer += opti_start-backward_start
-            self.optimizer.step()
-            
-            update_start = time.time()
-            opti_timer += update_start - opti_start
-            train_loss.update(loss.item(), data.size(0))
-            train_acc.update(output, label)
-            # train_f1.update(output, label)
-            update_timer += time.time() - update_start
-            # total_timer += time.time() - start_time
-            load_start = time.time()
-
-            i += 1
-            if i % 100 == 0:
-                print('Iter {}, Train Loss: {}, Train Acc: {}'.format(i+1, train_loss, train_acc))
-        self.timer = forward_timer
-        print("Forward Time : {}s".format(forward_timer))
-        print("Loss", loss_timer, "Backward", backward_timer, "Opti", opti_timer)
-        print("Update Time", update_timer)
-        print("Load Time", load_timer)
+            load_start = time.perf_counter()
+            for data, label, *soft in self.train_loader:
+                phases.record('load', load_start, time.perf_counter())
+                with phases.span('h2d'):
+                    data = data.to(self.device, non_blocking=True)
+                    label = label.to(self.device, non_blocking=True)
+                    soft = [logits.to(self.device, non_blocking=True) for logits in soft]
+                i += 1
+                # gradients are only averaged between the ranks
+                # on the last micro-batch of every optimizer step
+                sync = i % self.accum == 0 or i == num_batches
+                no_sync = getattr(self.net, 'no_sync', None)
+                with nullcontext() if sync or no_sync is None else no_sync():
+                    with self.autocast():
+                        with phases.span('forward'):
+                            # the teacher counts towards the forward time the split balances
+                            if self.teacher is not None and not soft:
+                                with torch.no_grad():
+                                    soft = [self.teacher(data)]
+                            output = self.net(data)
+                        with phases.span('loss'):
+                            loss = self.loss(output, label.float(), *soft)
+                    with phases.span('backward'):
+                        # averaged over the micro-batches of this step, fewer
+                        # than accum in the last one of an uneven epoch
+                        window = min(self.accum, num_batches - (i - 1)//self.accum*self.accum)
+                        self.scaler.scale(loss/window).backward()
+
+                if sync:
+                    with phases.span('optimizer'):
+                        comm_bytes += self.gradient_bytes()
+                        self.scaler.step(self.optimizer)
+                        self.scaler.update()
+                        self.optimizer.zero_grad()
+                        if self.scheduler is not None:
+                            self.scheduler.step()
+                    optimizer_steps += 1
+                    if self.local_sgd is not None:
+                        with phases.span('allreduce_wait'):
+                            self.local_sgd.step(step_samples + data.size(0))
+                    step_samples = 0
+                    # in-epoch positions are only the same on all
+                    # ranks when they all take the same steps, and
+                    # local SGD ranks only agree right after averaging;
+                    # checkpoints are counted in optimizer steps, the
+                    # position saved is in micro-batches for set_start,
+                    # rounded up for the short last step of the epoch
+                    if (self.checkpointer is not None and not self.stealing
+                            and self.checkpointer.due(-(-(self.start_step + i)//self.accum))
+                            and (self.local_sgd is None or self.local_sgd.steps == 0)):
+                        self.checkpoint(self.start_step + i)
+                else:
+                    step_samples += data.size(0)
+
+                with phases.span('metrics'):
+                    train_loss.update(loss, data.size(0))
+                    train_acc.update(output, label)
+                phases.step_done()
+                if self.telemetry is not None:
+                    self.telemetry.step(phases, data.size(0))
+
+                if i % 100 == 0:
+                    print('Iter {}, Train Loss: {}, Train Acc: {}'.format(i+1, train_loss, train_acc))
+                load_start = time.perf_counter()
+            finish = time.time()
+        sampler = self.train_loader.sampler
+        if self.start_step > 0 or getattr(sampler, 'remaining', None) is not None:
+            # the next epoch starts from the beginning again, on all the data
+            self.start_step = 0
+            sampler.set_start(0)
+            sampler.remaining = None
+        if self.stealing:
+            idle = gather_idle_time(time.time() - finish)
+            print("Stolen chunks", self.train_loader.batch_sampler.chunks)
+            print("Idle Time per rank", ["{:.3f}".format(t) for t in idle])
+        # the dynamic split balances the forward time
+        self.timer = phases.totals['forward']
+        if self.local_sgd is not None:
+            # every rank leaves the epoch with the same model
+            self.local_sgd.average()
+            print("Model Averages", self.local_sgd.averages, "Period", self.local_sgd.period)
+        if counter is not None:
+            comm_bytes = counter.bytes - counted_start
+        self.optimizer_steps = optimizer_steps
+        self.comm_bytes = comm_bytes
+        print("Optimizer Steps", optimizer_steps, "Allreduce Volume Sent {:.1f}MB".format(comm_bytes/1e6))
+        print("Phases", phases.summary())
+        if phases.enabled:
+            print(phases.report())
         print("---")
         return train_loss, train_acc
 
     def evaluate(self):
         test_loss = Average()
         test_acc = Accuracy()
+        test_f1 = ConfusionMatrix(self.classes)
 
-        self.net.eval()
+        # every rank evaluates its own share, so skip the
+        # DistributedDataParallel wrapper and its collectives
+        net = getattr(self.net, 'module', self.net)
+        net.eval()
         with torch.no_grad():
-            for data, label in self.test_loader:
-                data = data.cuda(non_blocking=True)
-                label = label.cuda(non_blocking=True)
+            for data, label, *_ in self.test_loader:
+                data = data.to(self.device, non_blocking=True)
+                label = label.to(self.device, non_blocking=True)
 
-                output = self.net(data)
-                loss = self.loss(output, label.float())
+                with self.autocast():
+                    output = net(data)
+                    loss = self.loss(output, label.float())
 
-                test_loss.update(loss.item(), data.size(0))
+                test_loss.update(loss, data.size(0))
                 test_acc.update(output, label)
+                test_f1.update(output, label)
 
-        return test_loss, test_acc
-
-
-class RNN(nn.Module):   
-    def __init__(self, n_vocab):
-        super().__init__()
-        self.n_vocab = n_vocab
-        self.embedding_size = 100
-        self.hidden_size = 32
-        self.num_layers = 2
-        self.word_embeddings = nn.Embedding(self.n_vocab, self.embedding_size)
-        self.lstm = nn.LSTM(self.embedding_size, self.hidden_size, self.num_layers, dropout=0.5)
-        self.fc1 = nn.Linear(self.hidden_size, self.hidden_size)
-        self.fc2 = nn.Linear(self.hidden_size, 1)
-        self.relu = nn.ReLU()
-        
-    def forward(self, sentence):
-        embeds = self.word_embeddings(sentence)
-        lstm_out, _ = self.lstm(embeds.permute(1,0,2))
-        fc1_out = self.fc1(lstm_out[-1])
-        fc2_out = self.fc2(self.relu(fc1_out))
-        return fc2_out 
+        return test_loss, test_acc, test_f1
 
+    def note_rows(self, param):
+        def hook(grad):
+            self.sparse_rows.setdefault(id(param), []).append(grad._indices()[0])
+        return hook
 
-def get_dataloader(root, batch_size, workers = 0):
-    amazon = DatasetAmazon(root)
+    def gradient_bytes(self):
+        # size of the gradients this rank sends in one allreduce, a sparse
+        # gradient carries the rows it touched, coalesced, and their indices
+        total = 0
+        for p in self.net.parameters():
+            if p.grad is None:
+                continue
+            if p.grad.is_sparse:
+                rows = self.sparse_rows.pop(id(p), [])
+                nnz = torch.cat(rows).unique().numel() if rows else 0
+                row = p.grad.size(1)*p.grad.element_size()
+                total += nnz*(row + 8*p.grad.sparse_dim())
+            else:
+                total += p.numel()*p.element_size()
+        return total
+
+    def autocast(self):
+        return torch.autocast(self.device.type, dtype=self.amp_dtype,
+                              enabled=self.amp_dtype is not None)
+
+
+def measure_inference(net, loader, device):
+    # test accuracy and reviews/s of the forward pass alone, over the
+    # shards of all the ranks, which run at the same time
+    net.eval()
+    accuracy = Accuracy()
+    start = time.perf_counter()
+    with torch.inference_mode():
+        for data, label, *_ in loader:
+            accuracy.update(net(data.to(device)), label.to(device))
+    seconds = torch.tensor([time.perf_counter() - start], device=collective_device())
+    dist.all_reduce(seconds, op=dist.ReduceOp.MAX)
+    accuracy.all_reduce()
+    return accuracy.accuracy, accuracy.count/seconds.item()
+
+
+def slow_down(model, factor):
+    # turn this rank into an artificial straggler whose
+    # forward pass takes factor times as long
+    def start(module, inputs):
+        module.forward_start = time.time()
+
+    def finish(module, inputs, output):
+        time.sleep((factor - 1)*(time.time() - module.forward_start))
+    model.register_forward_pre_hook(start)
+    model.register_forward_hook(finish)
+
+
+def get_optimizer(model, lr, momentum=0.9):
+    # rows of a sparse embedding are updated without momentum, as a momentum
+    # buffer would collect every row ever touched and turn dense
+    sparse = [m.weight for m in model.modules()
+              if isinstance(m, (nn.Embedding, nn.EmbeddingBag)) and m.sparse]
+    dense = [p for p in model.parameters() if all(p is not q for q in sparse)]
+    groups = [{'params': dense}]
+    if sparse:
+        groups.append({'params': sparse, 'momentum': 0.})
+    return torch.optim.SGD(groups, lr, momentum=momentum)
+
+
+class RatingLoss(nn.CrossEntropyLoss):
+    # cross entropy over the star ratings, taking the (batch, 1)
+    # labels Trainer passes to the binary loss as well
+    def forward(self, output, label):
+        return super().forward(output, label.long().view(-1))
+
+
+def get_loss(classes=2):
+    if classes == 2:
+        return nn.BCEWithLogitsLoss(pos_weight=torch.FloatTensor([5]))
+    return RatingLoss()
+
+
+def get_warmup_scheduler(optimizer, warmup):
+    # ramp the learning rate up linearly over the first optimizer steps
+    return torch.optim.lr_scheduler.LambdaLR(
+        optimizer, lambda step: min(1., (step + 1)/warmup) if warmup > 0 else 1.)
+
+
+def get_dataset(root, synthetic = 0, classes = 2):
+    if synthetic > 0:
+        return DatasetSynthetic(synthetic, classes=classes)
+    return DatasetAmazon(root, classes)
+
+
+def get_datasets(root, synthetic = 0, classes = 2, logits = None):
+    amazon = get_dataset(root, synthetic, classes)
+    if logits is not None:
+        # the teacher's logits of every review for distillation
+        amazon = WithLogits(amazon, logits)
     train_length = int(0.9 * len(amazon))
     test_length = len(amazon)-train_length
-    amz_train, amz_test = random_split(amazon,(train_length,test_length))
-    sampler = DistributedSampler(amz_train)
-    train_loader = data.DataLoader(amz_train, shuffle=(sampler is None), batch_size=batch_size, \
-                        sampler=sampler, num_workers=workers, drop_last=True)
-    test_loader = data.DataLoader(amz_test, shuffle=False, batch_size=batch_size, num_workers=workers, drop_last=True)
+    # every rank has to draw the same train/test split
+    generator = torch.Generator().manual_seed(0)
+    return random_split(amazon,(train_length,test_length), generator=generator)
+
+
+def get_dataloader(root, batch_size, workers = 0, steal_chunk = 0, synthetic = 0, classes = 2,
+                   logits = None):
+    amz_train, amz_test = get_datasets(root, synthetic, classes, logits)
+    if steal_chunk > 0:
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+        batch_sampler = WorkStealingBatchSampler(amz_train, batch_size,
+                            get_steal_store(rank, world_size), rank, world_size, steal_chunk)
+        train_loader = data.DataLoader(amz_train, batch_sampler=batch_sampler, num_workers=workers)
+    else:
+        sampler = DistributedSampler(amz_train)
+        train_loader = data.DataLoader(amz_train, shuffle=(sampler is None), batch_size=batch_size, \
+                            sampler=sampler, num_workers=workers, drop_last=True)
+    # the test set is sharded over the ranks without dropping any review
+    test_loader = data.DataLoader(amz_test, batch_size=batch_size, sampler=DistributedEvalSampler(amz_test),
+                                  num_workers=workers)
 
     return train_loader, test_loader
 
@@ -239,14 +610,79 @@ if __name__ == '__main__':
     print("Collect Inputs...")
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("--local_rank", type=int)
+    parser.add_argument("--local_rank", "--local-rank", type=int,
+                        default=int(os.environ.get('LOCAL_RANK', 0)))
     parser.add_argument("--dir", type=str, default='data.h5')
     parser.add_argument("--batch", type=int, default=32)
     parser.add_argument("--epochs", type=int, default=10)
     parser.add_argument("--workers", type=int, default=0)
-    parser.add_argument("--n_vocab", type=int, default=1e4)
+    parser.add_argument("--n_vocab", type=int, default=10000)
+    parser.add_argument("--model", type=str, default='lstm', choices=sorted(MODELS))
+    parser.add_argument("--embedding_size", type=int, default=None)
+    parser.add_argument("--hidden_size", type=int, default=None)
+    parser.add_argument("--num_layers", type=int, default=None,
+                        help="recurrent or convolutional layers")
     parser.add_argument("--dynamic", type=int, default=0)
+    parser.add_argument("--steal_chunk", type=int, default=0)
+    parser.add_argument("--balance", type=str, default='proportional', choices=sorted(SPLIT_POLICIES))
+    parser.add_argument("--device", type=str, default='cuda', choices=['cuda', 'cpu'])
+    parser.add_argument("--backend", type=str, default=None)
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--synthetic", type=int, default=0)
+    parser.add_argument("--sequence", type=str, default='padded',
+                        choices=['padded', 'packed', 'trimmed'])
+    parser.add_argument("--lr", type=float, default=0.05)
+    parser.add_argument("--accum", type=int, default=1)
+    parser.add_argument("--base_batch", type=int, default=0)
+    parser.add_argument("--warmup", type=int, default=0)
+    parser.add_argument("--sparse", action='store_true')
+    parser.add_argument("--compression", type=str, default='none', choices=['none'] + sorted(HOOKS))
+    parser.add_argument("--topk_ratio", type=float, default=0.01)
+    parser.add_argument("--powersgd_rank", type=int, default=1)
+    parser.add_argument("--local_sgd", type=int, default=0)
+    parser.add_argument("--local_sgd_momentum", action='store_true')
+    parser.add_argument("--local_sgd_adaptive", action='store_true')
+    parser.add_argument("--straggler", type=str, default=None,
+                        help="rank:factor, slow the forward pass of one rank down")
+    parser.add_argument("--classes", type=int, default=2, choices=[2, 5],
+                        help="positive/negative label or the star rating")
+    parser.add_argument("--checkpoint", type=str, default=None,
+                        help="checkpoint file, training resumes from it if it exists")
+    parser.add_argument("--checkpoint_every", type=int, default=0,
+                        help="optimizer steps between checkpoints, 0 for every epoch")
+    parser.add_argument("--profile", type=str, default=None,
+                        help="directory for synchronized phase timings and traces")
+    parser.add_argument("--profile_steps", type=str, default=None,
+                        help="first:count, steps to capture with torch.profiler")
+    parser.add_argument("--telemetry", type=str, default=None,
+                        help="JSONL file rank 0 appends the cluster throughput reports to")
+    parser.add_argument("--telemetry_every", type=int, default=50, help="steps between reports")
+    parser.add_argument("--straggler_threshold", type=float, default=1.5,
+                        help="slowdown against the median rank that counts as straggling")
+    parser.add_argument("--straggler_patience", type=int, default=3,
+                        help="reports in a row a rank straggles before it is flagged")
+    parser.add_argument("--exclude_threshold", type=float, default=0.,
+                        help="slowdown past which a flagged rank gets one sample per step, 0 never")
+    parser.add_argument("--teacher", type=str, default=None,
+                        help="checkpoint of the model to distill into --model")
+    parser.add_argument("--teacher_cache", type=str, default=None,
+                        help="file with the teacher's logits of the dataset, computed if out of date")
+    parser.add_argument("--distill_alpha", type=float, default=0.5,
+                        help="weight of the teacher's soft targets against the labels")
+    parser.add_argument("--temperature", type=float, default=2.)
+    parser.add_argument("--amp", type=str, default='off', choices=['off', 'bf16', 'fp16'])
+    parser.add_argument("--calibrate", action='store_true')
+    parser.add_argument("--calibration_cache", type=str,
+                        default=os.path.expanduser('~/.cache/sentiment_rnn/calibration.json'))
     args = parser.parse_args()
+    if args.sparse and args.compression != 'none':
+        parser.error("communication hooks don't support sparse gradients")
+    if args.sparse and (args.backend or ('nccl' if args.device == 'cuda' else 'gloo')) == 'nccl':
+        parser.error("nccl can't allreduce sparse gradients, use --backend gloo")
+    if args.local_sgd > 0 and args.compression != 'none':
+        parser.error("local SGD averages models and sends no gradients to compress")
+    if args.model == 'cnn' and args.num_layers is not None and args.num_layers < 1:
+        parser.error("the CNN needs at least one convolutional layer")
     
     # number of vocabulary
     num_vocab = args.n_vocab
@@ -265,17 +701,35 @@ if __name__ == '__main__':
     # if not updates every given argument
     dynamic_step = args.dynamic
 
+    # batches per chunk handed out by the work-stealing sampler
+    # 0 keeps the static per-rank splits of the dynamic sampler
+    steal_chunk = args.steal_chunk
+
     # Starting Learning Rate
-    starting_lr = 0.05
+    starting_lr = args.lr
+
+    # Micro-batches accumulated per optimizer step
+    accum = args.accum
+
+    # Optimizer steps over which the learning rate warms up
+    warmup = args.warmup
 
     # Distributed backend type
-    dist_backend = 'nccl'
+    # nccl needs GPUs, gloo runs the whole pipeline on CPU processes
+    dist_backend = args.backend or ('nccl' if args.device == 'cuda' else 'gloo')
+
+    # Intra-op threads per process, 0 keeps the torch default
+    # when running several CPU processes on one host use cores // processes
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
     print("Data Directory: {}".format(args.dir))
     print("Batch Size: {}".format(args.batch))
     print("Max Number of Epochs: {}".format(args.epochs))
     print("Initialize Process Group...")
 
-    torch.cuda.set_device(args.local_rank)
+    if args.device == 'cuda':
+        torch.cuda.set_device(args.local_rank)
 
     torch.distributed.init_process_group(backend=dist_backend,
                                          init_method='env://')
@@ -284,23 +738,109 @@ if __name__ == '__main__':
 
     # Establish Local Rank and set device on this node
     local_rank = args.local_rank
-    dp_device_ids = [local_rank]
+    if args.device == 'cuda':
+        device = torch.device('cuda', local_rank)
+        dp_device_ids = [local_rank]
+    else:
+        device = torch.device('cpu')
+        dp_device_ids = None
 
     print("Initialize Model...")
+    # the defaults of the model for the dimensions left out
+    dims = {'embedding_size': args.embedding_size, 'hidden_size': args.hidden_size,
+            'num_layers': args.num_layers}
     # Construct Model
-    model = RNN(num_vocab).cuda()
-
-    # Make model DistributedDataParallel
-    model = DistributedDataParallel(model, device_ids=dp_device_ids, output_device=local_rank)
+    model = get_model(args.model, num_vocab, args.sequence, args.sparse, args.classes,
+                      **dims).to(device)
+    if args.straggler:
+        straggler, factor = args.straggler.split(':')
+        if int(straggler) == dist.get_rank():
+            slow_down(model, float(factor))
+
+    # Make model DistributedDataParallel, unless the ranks
+    # train on their own and only average every few steps
+    if args.local_sgd == 0:
+        model = DistributedDataParallel(model, device_ids=dp_device_ids,
+                                        output_device=local_rank if dp_device_ids else None)
+    compression = None
+    if args.compression != 'none':
+        compression = register_compression(model, args.compression, args.topk_ratio,
+                                           args.powersgd_rank)
 
     # define loss function (criterion) and optimizer
-    loss = nn.BCEWithLogitsLoss(pos_weight=torch.FloatTensor([5]).cuda()).cuda()
-    optimizer = torch.optim.SGD(model.parameters(), starting_lr, momentum=0.9)
+    loss = get_loss(args.classes).to(device)
+    teacher = None
+    if args.teacher:
+        teacher = load_teacher(args.teacher, device, args.classes)
+        loss = DistillationLoss(loss, args.distill_alpha, args.temperature)
+    # scale the learning rate linearly with the effective batch, relative
+    # to base_batch which defaults to one micro-batch on every rank
+    effective_batch = batch_size*dist.get_world_size()*accum
+    base_batch = args.base_batch or batch_size*dist.get_world_size()
+    starting_lr = starting_lr*effective_batch/base_batch
+    print("Effective Batch: {}, Learning Rate: {}".format(effective_batch, starting_lr))
+    optimizer = get_optimizer(model, starting_lr)
+    scheduler = get_warmup_scheduler(optimizer, warmup)
+    local_sgd = None
+    if args.local_sgd > 0:
+        local_sgd = LocalSGD(model, optimizer, args.local_sgd, args.local_sgd_momentum,
+                             args.local_sgd_adaptive)
 
     print("Initialize Dataloaders...")
-    train_loader, test_loader = get_dataloader(args.dir, batch_size, workers)
+    logits = None
+    if teacher is not None and args.teacher_cache:
+        print("Teacher Logits...")
+        logits = cached_logits(teacher, args.teacher, args.teacher_cache,
+                               get_dataset(args.dir, args.synthetic, args.classes), device)
+    train_loader, test_loader = get_dataloader(args.dir, batch_size, workers, steal_chunk,
+                                               args.synthetic, args.classes, logits)
+    if args.teacher:
+        accuracy, throughput = measure_inference(teacher, test_loader, device)
+        print("Teacher test acc: {:.2f}%, inference {:.1f} reviews/s".format(accuracy*100, throughput))
+    if args.calibrate and steal_chunk == 0:
+        # time every rank before epoch 1 to start from a balanced split
+        print("Calibrating...")
+        overheads, costs = calibrate(lambda: get_model(args.model, num_vocab, args.sequence,
+                                                       args.sparse, args.classes, **dims),
+                                     device, review_lengths(train_loader.dataset),
+                                     args.calibration_cache)
+        train_loader = get_calibrated_loader(train_loader, overheads, costs,
+                                             batch_size*dist.get_world_size())
     print("Training...")
-    trainer = Trainer(model, optimizer, train_loader, test_loader, loss)
+    restarts = int(os.environ.get('TORCHELASTIC_RESTART_COUNT', 0))
+    if restarts > 0:
+        print("Elastic restart {} with {} processes".format(restarts, dist.get_world_size()))
+    checkpointer = None
+    if args.checkpoint:
+        # how to rebuild the model, for tools loading the checkpoint
+        config = dict(dims, model=args.model, n_vocab=num_vocab, sequence=args.sequence,
+                      sparse=args.sparse, classes=args.classes)
+        checkpointer = AsyncCheckpointer(args.checkpoint, args.checkpoint_every,
+                                         {'model_config': config})
+    profile_steps = None
+    if args.profile_steps:
+        profile_steps = tuple(int(v) for v in args.profile_steps.split(':'))
+    phases = PhaseTimer(args.profile is not None, device, dist.get_rank(), profile_steps,
+                        args.profile)
+    telemetry = None
+    if args.telemetry:
+        telemetry = Telemetry(args.telemetry, args.telemetry_every, args.straggler_threshold,
+                              args.straggler_patience, args.exclude_threshold)
+    trainer = Trainer(model, optimizer, train_loader, test_loader, loss, device, args.balance,
+                      args.amp, accum, scheduler, compression, local_sgd, args.classes,
+                      checkpointer, phases, telemetry,
+                      # the cached logits come with every review otherwise
+                      teacher if logits is None else None)
+    if args.checkpoint:
+        state = load_checkpoint(args.checkpoint)
+        if state is not None:
+            trainer.load_state_dict(state)
+            print("Resumed from {} at epoch {} step {}".format(
+                args.checkpoint, state['epoch'] + 1, state['step']))
     trainer.fit(num_epochs)
+    if args.teacher:
+        accuracy, throughput = measure_inference(getattr(model, 'module', model), trainer.test_loader,
+                                                 device)
+        print("Student test acc: {:.2f}%, inference {:.1f} reviews/s".format(accuracy*100, throughput))
 
     print("Total time: {:.3f}s".format(time.time()-initial_time))
\ No newline at end of file
@@ -0,0 +1,167 @@
+"""
+Export of a trained RNN for CPU inference
+
+Turns a checkpoint written with dynamic_rnn.py --checkpoint into a
+TorchScript file that runs without this repository:
+
+    python export_model.py --checkpoint run.pt --output rnn.pt
+    python export_model.py --checkpoint run.pt --output rnn_int8.pt --quantize linear,embedding
+    python export_model.py --checkpoint run.pt --output rnn_int8.pt --quantize lstm,linear,embedding \
+        --benchmark --synthetic 4000
+
+--quantize lists the layers to store in int8. The LSTM and linear layers
+become their dynamic int8 versions, whose weights are int8 and whose
+activations are quantized on the fly per batch. The embedding table keeps
+one 8-bit value per weight plus a scale and offset per word, a quarter
+of its fp32 size. The embedding dominates the file, so it matters most for
+the size on disk. With a hidden size of 32 the GEMMs of the LSTM are too
+small for int8 to pay off: on one core the int8 LSTM ran 2-3x slower than
+fp32, while linear,embedding ran as fast as fp32.
+
+For the LSTM and GRU the export scripts InferenceRNN rather than RNN: it
+shares the trained layers but only has the padded and the trimmed forward
+pass, packed gives the same result as trimmed. The other models of
+models.py script as they are. torch.export is not used, it has no support
+for the packed weights of the eager dynamic quantized modules.
+
+--benchmark compares the fp32 model with the exported one: latency per
+batch of 1, 32 and 256 test reviews, size on disk and test accuracy.
+"""
+
+import os
+import copy
+import time
+import argparse
+import tempfile
+import warnings
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.ao.quantization as quantization
+from models import RNN, PAD, load_model, is_torchscript, predict
+
+
+class InferenceRNN(nn.Module):
+    # the forward pass of RNN in a form torch.jit.script compiles
+    def __init__(self, model):
+        super().__init__()
+        self.n_vocab = model.n_vocab
+        self.classes = model.classes
+        self.padded = model.sequence == 'padded'
+        self.pad = PAD
+        self.word_embeddings = model.word_embeddings
+        self.lstm = model.lstm
+        self.fc1 = model.fc1
+        self.fc2 = model.fc2
+        self.relu = model.relu
+
+    def forward(self, sentence):
+        if self.padded:
+            lstm_out, _ = self.lstm(self.word_embeddings(sentence).permute(1, 0, 2))
+            last = lstm_out[-1]
+        else:
+            lengths = sentence.ne(self.pad).sum(1).clamp(min=1)
+            embeds = self.word_embeddings(sentence[:, :int(lengths.max())].contiguous())
+            lstm_out, _ = self.lstm(embeds.permute(1, 0, 2))
+            last = lstm_out[lengths - 1, torch.arange(lengths.size(0), device=lengths.device)]
+        return self.fc2(self.relu(self.fc1(last)))
+
+
+QUANTIZABLE = {
+    'lstm': [(nn.LSTM, quantization.default_dynamic_qconfig)],
+    'gru': [(nn.GRU, quantization.default_dynamic_qconfig)],
+    'linear': [(nn.Linear, quantization.default_dynamic_qconfig)],
+    'embedding': [(nn.Embedding, quantization.float_qparams_weight_only_qconfig),
+                  (nn.EmbeddingBag, quantization.float_qparams_weight_only_qconfig)],
+}
+
+
+def quantize(model, layers=('lstm', 'linear', 'embedding')):
+    # int8 copy of model with the given kinds of layers quantized
+    qconfig_spec = dict(spec for layer in layers for spec in QUANTIZABLE[layer])
+    with warnings.catch_warnings():
+        # eager mode quantization is deprecated in favour of torchao
+        warnings.simplefilter('ignore')
+        return quantization.quantize_dynamic(copy.deepcopy(model), qconfig_spec, dtype=torch.qint8)
+
+
+def export(model, path, layers=()):
+    # the models of models.py other than the RNNs script as they are
+    model = (InferenceRNN(model) if isinstance(model, RNN) else model).eval()
+    if layers:
+        model = quantize(model, layers)
+    scripted = torch.jit.script(model)
+    scripted.save(path)
+    return scripted
+
+
+def latency(model, test_set, batch_size, repeats=20):
+    # median seconds per batch of the first reviews of the test set
+    reviews = torch.stack([test_set[i % len(test_set)][0] for i in range(batch_size)])
+    times = []
+    with torch.inference_mode():
+        model(reviews)
+        for _ in range(repeats):
+            start = time.perf_counter()
+            model(reviews)
+            times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def accuracy(model, test_set, batch_size=256):
+    correct = 0
+    loader = torch.utils.data.DataLoader(test_set, batch_size=batch_size)
+    with torch.inference_mode():
+        for text, label in loader:
+            correct += int(predict(model(text)).eq(label).sum())
+    return correct/len(test_set)
+
+
+def benchmark(model, exported, path, test_set, batches=(1, 32, 256)):
+    # fp32 eager, fp32 scripted and the exported model side by side
+    with tempfile.TemporaryDirectory() as directory:
+        fp32_path = os.path.join(directory, 'fp32.pt')
+        fp32 = export(model, fp32_path)
+        rows = [('fp32 eager', model, None), ('fp32 script', fp32, os.path.getsize(fp32_path)),
+                ('exported', exported, os.path.getsize(path))]
+        print('{:>12} {:>9} {}  {:>8}'.format(
+            'model', 'size MB', ' '.join('{:>9}'.format('b{} ms'.format(b)) for b in batches), 'test acc'))
+        baseline = None
+        for name, m, size in rows:
+            acc = accuracy(m, test_set)
+            baseline = acc if baseline is None else baseline
+            print('{:>12} {:>9} {}  {:>7.2%} ({:+.2%})'.format(
+                name, '-' if size is None else '{:.2f}'.format(size/1e6),
+                ' '.join('{:>9.3f}'.format(latency(m, test_set, b)*1000) for b in batches),
+                acc, acc - baseline))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint", type=str, required=True)
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--quantize", type=str, default='',
+                        help="comma separated layers to store in int8: " + ', '.join(sorted(QUANTIZABLE)))
+    parser.add_argument("--benchmark", action='store_true')
+    parser.add_argument("--dir", type=str, default='data.h5', help="test data for the benchmark")
+    parser.add_argument("--synthetic", type=int, default=0)
+    parser.add_argument("--threads", type=int, default=1, help="intra-op threads, 0 for the default")
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    layers = [layer for layer in args.quantize.split(',') if layer]
+    for layer in layers:
+        if layer not in QUANTIZABLE:
+            parser.error("unknown layer {}".format(layer))
+    if is_torchscript(args.checkpoint):
+        parser.error("{} is already a TorchScript export".format(args.checkpoint))
+    model = load_model(args.checkpoint)
+    exported = export(model, args.output, layers)
+    print("Exported to {}, {:.2f}MB".format(args.output, os.path.getsize(args.output)/1e6))
+    if args.benchmark:
+        # the test split of the training runs, only the
+        # benchmark needs the training module
+        from dynamic_rnn import get_datasets
+        _, test_set = get_datasets(args.dir, args.synthetic, model.classes)
+        benchmark(model, exported, args.output, test_set)
@@ -0,0 +1,172 @@
+"""
+Hogwild: lock-free asynchronous SGD on one multi-core CPU host
+
+The RNN lives in shared memory once and N worker processes train it at the
+same time, every one on a disjoint range of the shuffled training set and
+with its own optimizer, writing its updates to the shared parameters
+without any locking or allreduce. Every worker uses 1/N of the learning
+rate, which keeps the combined update of the shared model at the size of
+one DDP step. After every epoch the main process evaluates the shared model.
+
+    python hogwild.py --dir data.h5 --procs 1,2,4,8
+    python hogwild.py --synthetic 20000 --procs 1,2,4 --sequence trimmed
+
+prints the samples/s scaling over the process counts. benchmark.py hogwild
+puts the same numbers next to synchronous DDP.
+"""
+
+import time
+import argparse
+import threading
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+from torch.utils import data
+from dynamic_rnn import Average, Accuracy, get_datasets, get_optimizer
+from models import RNN
+
+
+def hogwild_indices(length, rank, procs, epoch, seed=0):
+    # the disjoint range of this epoch's permutation a worker trains on
+    g = torch.Generator()
+    g.manual_seed(seed + epoch)
+    indices = torch.randperm(length, generator=g)
+    per_worker = length//procs
+    return indices[rank*per_worker:(rank + 1)*per_worker].tolist()
+
+
+def train_worker(rank, procs, model, train_set, args, barrier, queue):
+    torch.manual_seed(args.seed + rank)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    # the optimizer state is private, only the parameters are shared. All
+    # workers together apply procs updates in the time DDP applies one
+    # averaged update, so every worker steps with 1/procs of the rate
+    optimizer = get_optimizer(model, args.lr/procs)
+    loss_fn = nn.BCEWithLogitsLoss(pos_weight=torch.FloatTensor([5]))
+    for epoch in range(1, args.epochs + 1):
+        indices = hogwild_indices(len(train_set), rank, procs, epoch, args.seed)
+        loader = data.DataLoader(data.Subset(train_set, indices), batch_size=args.batch,
+                                 shuffle=False, drop_last=True)
+        train_loss = Average()
+        train_acc = Accuracy()
+        model.train()
+        barrier.wait()
+        for text, label in loader:
+            optimizer.zero_grad()
+            output = model(text)
+            loss = loss_fn(output, label.float())
+            loss.backward()
+            optimizer.step()
+            train_loss.update(loss, text.size(0))
+            train_acc.update(output, label)
+        queue.put((rank, float(train_loss.sum), int(train_acc.correct), train_acc.count))
+        barrier.wait()
+
+
+def evaluate(model, test_set, batch_size):
+    loss_fn = nn.BCEWithLogitsLoss(pos_weight=torch.FloatTensor([5]))
+    test_loss = Average()
+    test_acc = Accuracy()
+    model.eval()
+    with torch.no_grad():
+        for text, label in data.DataLoader(test_set, batch_size=batch_size):
+            output = model(text)
+            test_loss.update(loss_fn(output, label.float()), text.size(0))
+            test_acc.update(output, label)
+    return test_loss, test_acc
+
+
+def watch(workers, barrier, interval=0.5):
+    # a worker that fails, even when it is killed, breaks the barrier
+    # the main process and the other workers wait on
+    while not all(worker.exitcode == 0 for worker in workers):
+        if any(worker.exitcode not in (None, 0) for worker in workers):
+            barrier.abort()
+            return
+        time.sleep(interval)
+
+
+def run(train_set, test_set, procs, args):
+    # train the shared model on procs workers and return one
+    # dict per epoch, in the format of Trainer.fit
+    torch.manual_seed(args.seed)
+    model = RNN(args.n_vocab, args.sequence, args.sparse)
+    # gradients stay in the workers, they are created after this
+    model.share_memory()
+    ctx = mp.get_context('spawn')
+    barrier = ctx.Barrier(procs + 1)
+    queue = ctx.SimpleQueue()
+    workers = [ctx.Process(target=train_worker,
+                           args=(rank, procs, model, train_set, args, barrier, queue))
+               for rank in range(procs)]
+    for worker in workers:
+        worker.start()
+    threading.Thread(target=watch, args=(workers, barrier), daemon=True).start()
+    history = []
+    try:
+        for epoch in range(1, args.epochs + 1):
+            barrier.wait()
+            epoch_start = time.time()
+            barrier.wait()
+            train_time = time.time() - epoch_start
+            results = [queue.get() for _ in range(procs)]
+            samples = sum(r[3] for r in results)
+            test_loss, test_acc = evaluate(model, test_set, args.batch)
+            history.append({
+                'epoch': epoch,
+                'train_time': train_time,
+                'epoch_time': time.time() - epoch_start,
+                'throughput': samples/train_time,
+                'train_loss': sum(r[1] for r in results)/samples,
+                'train_acc': sum(r[2] for r in results)/samples,
+                'test_loss': test_loss.average,
+                'test_acc': test_acc.accuracy,
+            })
+            print("Epoch: {}/{}, {:.1f} samples/s on {} processes, train loss: {:.6f}, "
+                  "test loss: {}, test acc: {}".format(epoch, args.epochs, samples/train_time,
+                                                       procs, history[-1]['train_loss'],
+                                                       test_loss, test_acc))
+    except threading.BrokenBarrierError:
+        # the others are stuck or fail on the broken barrier as well
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+        raise RuntimeError("hogwild workers exited with {}".format(
+            [worker.exitcode for worker in workers]))
+    for worker in workers:
+        worker.join()
+    return history
+
+
+def parse_ints(text):
+    return [int(v) for v in text.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", type=str, default='data.h5')
+    parser.add_argument("--synthetic", type=int, default=0)
+    parser.add_argument("--procs", type=parse_ints, default=[1, 2, 4])
+    parser.add_argument("--threads", type=int, default=1, help="intra-op threads per process")
+    parser.add_argument("--batch", type=int, default=32)
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--lr", type=float, default=0.05)
+    parser.add_argument("--n_vocab", type=int, default=10000)
+    parser.add_argument("--sequence", type=str, default='padded',
+                        choices=['padded', 'packed', 'trimmed'])
+    parser.add_argument("--sparse", action='store_true')
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    train_set, test_set = get_datasets(args.dir, args.synthetic)
+    rows = []
+    for procs in args.procs:
+        history = run(train_set, test_set, procs, args)
+        # the first epoch pays for starting the workers
+        throughput = sum(h['throughput'] for h in history[1:] or history)/max(len(history) - 1, 1)
+        rows.append((procs, throughput, history[-1]['test_acc']))
+    print("{:>6} {:>14} {:>10} {:>10}".format('procs', 'samples/s', 'speedup', 'test acc'))
+    for procs, throughput, test_acc in rows:
+        print("{:>6} {:>14.1f} {:>10.2f} {:>9.2f}%".format(
+            procs, throughput, throughput/rows[0][1], test_acc*100))
@@ -0,0 +1,110 @@
+"""
+Load generator for serve.py
+
+Every concurrency level runs that many clients for --duration seconds,
+each on its own keep-alive connection sending one review after the other,
+and reports the throughput, the latency percentiles seen by the clients,
+and the mean micro-batch size the server formed in the meantime.
+
+    python loadgen.py --port 8080 --concurrency 1,8,32,128 --reviews reviews.json
+
+Reviews are taken round robin from a raw review JSON lines file, or made
+up from words of the vocabulary without one.
+"""
+
+import json
+import time
+import random
+import asyncio
+import argparse
+import numpy as np
+
+
+def load_reviews(path, count, seed=0):
+    if path:
+        with open(path) as f:
+            return [json.loads(line)['reviewText'] for _, line in zip(range(count), f)]
+    with open('vocab_10000.json') as f:
+        vocab = list(json.load(f))
+    rng = random.Random(seed)
+    return [' '.join(rng.choice(vocab) for _ in range(rng.randint(5, 120))) for _ in range(count)]
+
+
+async def request(reader, writer, method, path, body=None):
+    payload = json.dumps(body).encode() if body is not None else b''
+    writer.write('{} {} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {}\r\n\r\n'.format(
+        method, path, len(payload)).encode() + payload)
+    await writer.drain()
+    status = await reader.readline()
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, value = line.decode().split(':', 1)
+        if name.lower() == 'content-length':
+            length = int(value)
+    body = json.loads(await reader.readexactly(length))
+    if not status.startswith(b'HTTP/1.1 200'):
+        raise RuntimeError(status.decode().strip(), body)
+    return body
+
+
+async def client(host, port, reviews, offset, stop, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    k = offset
+    while time.perf_counter() < stop:
+        start = time.perf_counter()
+        await request(reader, writer, 'POST', '/score', {'reviewText': reviews[k % len(reviews)]})
+        latencies.append(time.perf_counter() - start)
+        k += 1
+    writer.close()
+
+
+async def metrics(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    result = await request(reader, writer, 'GET', '/metrics')
+    writer.close()
+    return result
+
+
+async def run_level(host, port, reviews, concurrency, duration):
+    before = await metrics(host, port)
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(host, port, reviews, c*len(reviews)//concurrency,
+                                  start + duration, latencies) for c in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    after = await metrics(host, port)
+    batches = after['batches'] - before['batches']
+    latencies = np.array(latencies)*1000
+    return {
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'throughput': len(latencies)/elapsed,
+        'p50': np.percentile(latencies, 50),
+        'p99': np.percentile(latencies, 99),
+        'mean_batch': (after['requests'] - before['requests'])/batches if batches else 0.,
+    }
+
+
+async def main(args):
+    reviews = load_reviews(args.reviews, args.count)
+    print('{:>11} {:>9} {:>10} {:>9} {:>9} {:>10}'.format(
+        'concurrency', 'requests', 'req/s', 'p50 ms', 'p99 ms', 'mean batch'))
+    for concurrency in [int(c) for c in args.concurrency.split(',')]:
+        r = await run_level(args.host, args.port, reviews, concurrency, args.duration)
+        print('{concurrency:>11} {requests:>9} {throughput:>10.1f} {p50:>9.2f} {p99:>9.2f} '
+              '{mean_batch:>10.1f}'.format(**r), flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--concurrency", type=str, default='1,8,32,128')
+    parser.add_argument("--duration", type=float, default=10., help="seconds per concurrency level")
+    parser.add_argument("--reviews", type=str, default=None, help="raw review JSON lines")
+    parser.add_argument("--count", type=int, default=1000, help="distinct reviews to send")
+    args = parser.parse_args()
+    asyncio.run(main(args))
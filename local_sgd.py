@@ -0,0 +1,88 @@
+"""
+Local SGD: periodic model averaging instead of a gradient allreduce every step
+
+Every rank runs `period` optimizer steps on its own copy of the model and then
+the ranks average their parameters, and optionally their momentum buffers,
+weighted by the samples each of them processed since the last average. That
+keeps the dynamic split of get_dynamic_loader meaningful: a rank that got a
+bigger share of the data also gets a bigger say in the average.
+
+With adaptive=True the period is recomputed after every average so that the
+averaging takes about `target` of the time spent computing.
+"""
+
+import math
+import time
+import torch
+import torch.distributed as dist
+from dynamic_dataloader import collective_device
+
+
+class LocalSGD(object):
+    def __init__(self, model, optimizer, period=8, average_momentum=False,
+                 adaptive=False, target=0.1, max_period=256):
+        self.model = model
+        self.optimizer = optimizer
+        self.period = period
+        self.average_momentum = average_momentum
+        self.adaptive = adaptive
+        self.target = target
+        self.max_period = max_period
+        self.steps = 0
+        self.samples = 0
+        self.averages = 0
+        self.bytes = 0
+        self.comm_time = 0.
+        self.compute_start = time.time()
+        # start from the same model everywhere, as DistributedDataParallel does
+        for p in model.parameters():
+            dist.broadcast(p.data, 0)
+
+    def step(self, samples):
+        # call after every optimizer step with the samples it used
+        self.steps += 1
+        self.samples += samples
+        if self.steps >= self.period:
+            self.average()
+
+    def tensors(self):
+        tensors = [p.data for p in self.model.parameters()]
+        if self.average_momentum:
+            for p in self.model.parameters():
+                buf = self.optimizer.state.get(p, {}).get('momentum_buffer')
+                if buf is not None and not buf.is_sparse:
+                    tensors.append(buf)
+        return tensors
+
+    def average(self):
+        if self.steps == 0:
+            return
+        step_time = (time.time() - self.compute_start)/self.steps
+        comm_start = time.time()
+        tensors = self.tensors()
+        device = collective_device()
+        flat = torch.cat([t.reshape(-1).to(device, torch.float32) for t in tensors])
+        # the weighted sum, the total weight and the timings in one allreduce
+        weight = float(self.samples)
+        extra = torch.tensor([weight, self.comm_time, step_time], device=device)
+        flat = torch.cat([flat*weight, extra])
+        dist.all_reduce(flat)
+        total = flat[-3]
+        offset = 0
+        for t in tensors:
+            n = t.numel()
+            t.copy_((flat[offset:offset + n]/total).view_as(t))
+            offset += n
+        self.bytes += flat.numel()*flat.element_size()
+        self.averages += 1
+        if self.adaptive:
+            world_size = dist.get_world_size()
+            comm_time = flat[-2].item()/world_size
+            step_time = flat[-1].item()/world_size
+            if comm_time > 0:
+                period = math.ceil(comm_time/(self.target*step_time))
+                self.period = int(min(max(period, 1), self.max_period))
+        self.steps = 0
+        self.samples = 0
+        self.comm_time = time.time() - comm_start
+        self.compute_start = time.time()
@@ -15,12 +15,13 @@ def process_text(text):
     # purged_word_list = [word for word in text if word not in stop_words]
     return ' '.join(x)
 
-for line in sys.stdin:
-    #if i == 14000: break
-    data = json.loads(line.strip())
-    #print(data)
-    text = process_text(data['reviewText'])
-    #print(text)
-    if text != '':
-        print(text+'\t'+str(int(data['overall'])))#+'\t'+data['reviewerID']+'\t'+data['asin'])
+if __name__ == '__main__':
+    for line in sys.stdin:
+        #if i == 14000: break
+        data = json.loads(line.strip())
+        #print(data)
+        text = process_text(data['reviewText'])
+        #print(text)
+        if text != '':
+            print(text+'\t'+str(int(data['overall'])))#+'\t'+data['reviewerID']+'\t'+data['asin'])
     
\ No newline at end of file
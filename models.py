@@ -0,0 +1,187 @@
+"""
+Sentiment models
+
+Every model takes a (batch, 100) tensor of word ids, padded with PAD at the
+end as reducer.tokenize does, and returns one logit for the binary label or
+one per class, so they all train through the same Trainer:
+
+    lstm  the original RNN: embedding, LSTM, two linear layers
+    gru   the same with a GRU, three gates instead of four
+    cnn   1-D convolutions over the embeddings, max pooled over the words
+    bag   the mean of the word embeddings, no sequence model at all
+
+They share the constructor arguments (n_vocab, sequence, sparse, classes,
+embedding_size, hidden_size, num_layers), where num_layers counts the
+recurrent or convolutional layers and the bag of embeddings has none.
+build_model rebuilds one from the model_config of a checkpoint, and
+load_model loads a trained one for inference from a checkpoint or from a
+TorchScript export of export_model.py.
+"""
+
+import zipfile
+import torch
+import torch.nn as nn
+from torch.nn.utils.rnn import pack_padded_sequence
+from checkpoint import load_checkpoint
+
+# word id reducer.tokenize pads the reviews with
+PAD = 1
+
+
+def predict(output):
+    # class predictions from a single logit or from one logit per class
+    if output.size(1) == 1:
+        return torch.sigmoid(output.detach()).round().long()
+    return output.detach().argmax(1, keepdim=True)
+
+
+class RNN(nn.Module):
+    def __init__(self, n_vocab, sequence='padded', sparse=False, classes=2,
+                 embedding_size=100, hidden_size=32, num_layers=2):
+        super().__init__()
+        self.n_vocab = n_vocab
+        # a single logit for the binary label, one per class otherwise
+        self.classes = classes
+        # padded runs the LSTM over all 100 steps and classifies from the last one
+        # packed runs it over the words only with pack_padded_sequence
+        # trimmed cuts the padding shared by the whole batch and classifies
+        # every review from the output at its last word
+        self.sequence = sequence
+        self.embedding_size = embedding_size
+        self.hidden_size = hidden_size
+        self.num_layers = num_layers
+        # a sparse embedding gradient only holds the rows of the words in
+        # the batch, which is all DistributedDataParallel then exchanges
+        self.word_embeddings = nn.Embedding(self.n_vocab, self.embedding_size, sparse=sparse)
+        # the recurrent layer keeps its name in the checkpoints of every cell
+        self.lstm = self.recurrent_layer()
+        self.fc1 = nn.Linear(self.hidden_size, self.hidden_size)
+        self.fc2 = nn.Linear(self.hidden_size, 1 if classes == 2 else classes)
+        self.relu = nn.ReLU()
+
+    def recurrent_layer(self):
+        return nn.LSTM(self.embedding_size, self.hidden_size, self.num_layers, dropout=0.5)
+
+    def forward(self, sentence):
+        if self.sequence != 'padded':
+            # reviews are padded at the end, empty ones keep one step
+            lengths = sentence.ne(PAD).sum(1).clamp(min=1)
+        if self.sequence == 'packed':
+            embeds = self.word_embeddings(sentence)
+            packed = pack_padded_sequence(embeds.permute(1,0,2), lengths.cpu(), enforce_sorted=False)
+            _, hidden = self.lstm(packed)
+            # the LSTM returns its cell state along with the hidden one
+            last = (hidden[0] if isinstance(hidden, tuple) else hidden)[-1]
+        elif self.sequence == 'trimmed':
+            embeds = self.word_embeddings(sentence[:, :int(lengths.max())])
+            lstm_out, _ = self.lstm(embeds.permute(1,0,2))
+            last = lstm_out[lengths - 1, torch.arange(len(lengths), device=lengths.device)]
+        else:
+            embeds = self.word_embeddings(sentence)
+            lstm_out, _ = self.lstm(embeds.permute(1,0,2))
+            last = lstm_out[-1]
+        fc1_out = self.fc1(last)
+        fc2_out = self.fc2(self.relu(fc1_out))
+        return fc2_out
+
+
+class GRU(RNN):
+    def recurrent_layer(self):
+        return nn.GRU(self.embedding_size, self.hidden_size, self.num_layers, dropout=0.5)
+
+
+class CNN(nn.Module):
+    def __init__(self, n_vocab, sequence='padded', sparse=False, classes=2,
+                 embedding_size=100, hidden_size=32, num_layers=1, kernel_size=3):
+        super().__init__()
+        if num_layers < 1:
+            raise ValueError("the CNN needs num_layers >= 1, got {}".format(num_layers))
+        self.n_vocab = n_vocab
+        self.classes = classes
+        # anything but padded convolves up to the longest review of the batch only
+        self.sequence = sequence
+        self.pad = PAD
+        self.word_embeddings = nn.Embedding(n_vocab, embedding_size, sparse=sparse)
+        # with unit variance embeddings the max pooled convolutions
+        # diverge at the learning rate the LSTM trains with
+        nn.init.normal_(self.word_embeddings.weight, std=0.3)
+        self.convs = nn.ModuleList([
+            nn.Conv1d(embedding_size if layer == 0 else hidden_size, hidden_size,
+                      kernel_size, padding=kernel_size//2)
+            for layer in range(num_layers)])
+        self.fc1 = nn.Linear(hidden_size, hidden_size)
+        self.fc2 = nn.Linear(hidden_size, 1 if classes == 2 else classes)
+        self.relu = nn.ReLU()
+
+    def forward(self, sentence):
+        if self.sequence != 'padded':
+            # contiguous for the int8 embedding of export_model.py
+            sentence = sentence[:, :int(sentence.ne(self.pad).sum(1).max().clamp(min=1))].contiguous()
+        mask = sentence.ne(self.pad).unsqueeze(1)
+        features = self.word_embeddings(sentence).permute(0, 2, 1)
+        for conv in self.convs:
+            features = self.relu(conv(features))
+        # the features are not negative, so zeroing the
+        # padding keeps it out of the maximum
+        pooled = (features*mask).max(2)[0]
+        return self.fc2(self.relu(self.fc1(pooled)))
+
+
+class BagOfEmbeddings(nn.Module):
+    def __init__(self, n_vocab, sequence='padded', sparse=False, classes=2,
+                 embedding_size=100, hidden_size=32, num_layers=0):
+        super().__init__()
+        self.n_vocab = n_vocab
+        self.classes = classes
+        # the word order plays no part
+        self.sequence = sequence
+        # the mean over the words of every review, leaving out the padding
+        self.word_embeddings = nn.EmbeddingBag(n_vocab, embedding_size, mode='mean',
+                                               sparse=sparse, padding_idx=PAD)
+        self.fc1 = nn.Linear(embedding_size, hidden_size)
+        self.fc2 = nn.Linear(hidden_size, 1 if classes == 2 else classes)
+        self.relu = nn.ReLU()
+
+    def forward(self, sentence):
+        return self.fc2(self.relu(self.fc1(self.word_embeddings(sentence))))
+
+
+MODELS = {
+    'lstm': RNN,
+    'gru': GRU,
+    'cnn': CNN,
+    'bag': BagOfEmbeddings,
+}
+
+
+def get_model(name, n_vocab, sequence='padded', sparse=False, classes=2, **dims):
+    # dims: embedding_size, hidden_size, num_layers, the defaults of the model if left out
+    dims = {key: value for key, value in dims.items() if value is not None}
+    return MODELS[name](n_vocab, sequence, sparse, classes, **dims)
+
+
+def build_model(config):
+    # the model of a checkpoint's model_config, which
+    # names no model if it was written for the LSTM
+    config = dict(config)
+    return get_model(config.pop('model', 'lstm'), **config)
+
+
+def is_torchscript(path):
+    # TorchScript archives hold their constants next to the code
+    if not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as archive:
+        return any(name.endswith('/constants.pkl') for name in archive.namelist())
+
+
+def load_model(path, device='cpu'):
+    # a dynamic_rnn.py checkpoint or an export of export_model.py, in eval mode
+    if is_torchscript(path):
+        return torch.jit.load(path, map_location=device).eval()
+    state = load_checkpoint(path)
+    if state is None:
+        raise FileNotFoundError(path)
+    model = build_model(dict(state['model_config'], sparse=False))
+    model.load_state_dict(state['model'])
+    return model.to(device).eval()
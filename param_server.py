@@ -0,0 +1,317 @@
+"""
+Asynchronous parameter server over torch.distributed.rpc
+
+The parameters of the RNN are sharded over one or more server processes:
+every server owns a contiguous range of embedding rows and some of the
+dense tensors, and applies SGD to them as gradients come in. Trainer
+processes never wait for each other. Before every step a trainer pulls the
+dense parameters and only the embedding rows of the words in its batch,
+and after the backward pass it pushes the gradients to the servers that own
+them.
+
+Staleness is bounded per shard: every update a shard applies bumps its
+version, and a gradient computed on parameters more than `staleness`
+versions old is dropped instead of applied. Batches are handed out by a
+counter on the first server, so a slow trainer simply takes fewer of them.
+
+    python param_server.py --synthetic 20000 --procs 3 --servers 1
+    python param_server.py --dir data.h5 --procs 4 --servers 2 --straggler 0:3
+
+benchmark.py param_server compares it with DDP and the dynamic split.
+"""
+
+import os
+import time
+import argparse
+import threading
+from contextlib import redirect_stdout, nullcontext
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+import torch.distributed.rpc as rpc
+from torch.utils.data.dataloader import default_collate
+from dynamic_rnn import get_datasets, slow_down
+from models import RNN
+from hogwild import hogwild_indices, evaluate
+
+
+EMBEDDING = 'word_embeddings.weight'
+
+
+def row_bounds(rows, servers):
+    # contiguous embedding row range of every server
+    return [rows*s//servers for s in range(servers + 1)]
+
+
+def place_dense(model, servers):
+    # the server of every dense tensor, largest first on the
+    # server holding the fewest elements
+    bounds = row_bounds(model.n_vocab, servers)
+    load = [(bounds[s + 1] - bounds[s])*model.word_embeddings.embedding_dim
+            for s in range(servers)]
+    placement = {}
+    dense = [(name, p) for name, p in model.named_parameters() if name != EMBEDDING]
+    for name, p in sorted(dense, key=lambda item: -item[1].numel()):
+        server = load.index(min(load))
+        placement[name] = server
+        load[server] += p.numel()
+    return placement
+
+
+class ParameterShard(object):
+    def __init__(self, model, server, servers, lr, trainers, staleness):
+        self.lock = threading.Lock()
+        self.version = 0
+        self.staleness = staleness
+        self.dropped = 0
+        bounds = row_bounds(model.n_vocab, servers)
+        self.start = bounds[server]
+        self.rows = model.word_embeddings.weight.detach()[bounds[server]:bounds[server + 1]].clone()
+        placement = place_dense(model, servers)
+        self.dense = {name: p.detach().clone() for name, p in model.named_parameters()
+                      if placement.get(name) == server}
+        # the update of get_optimizer, with the rate split between the
+        # trainers as they all update the same parameters
+        groups = [{'params': [self.rows], 'momentum': 0.}]
+        if self.dense:
+            groups.append({'params': list(self.dense.values())})
+        self.optimizer = torch.optim.SGD(groups, lr/trainers, momentum=0.9)
+        # batch hand-out and completion, only used on the first server
+        self.trainers = trainers
+        self.condition = threading.Condition()
+        self.claimed = {}
+        self.finished = {}
+
+    def pull(self, ids):
+        with self.lock:
+            dense = {name: p.clone() for name, p in self.dense.items()}
+            return self.version, dense, self.rows[ids - self.start].clone()
+
+    def push(self, version, grads, ids, values):
+        with self.lock:
+            if self.version - version > self.staleness:
+                self.dropped += 1
+                return False
+            for name, grad in grads.items():
+                self.dense[name].grad = grad
+            self.rows.grad = torch.sparse_coo_tensor((ids - self.start).unsqueeze(0), values,
+                                                     self.rows.shape, check_invariants=False)
+            self.optimizer.step()
+            self.optimizer.zero_grad()
+            self.version += 1
+            return True
+
+    def claim(self, epoch, batches):
+        with self.condition:
+            k = self.claimed.get(epoch, 0)
+            if k >= batches:
+                return -1
+            self.claimed[epoch] = k + 1
+            return k
+
+    def finish(self, trainer, stats):
+        with self.condition:
+            self.finished[trainer] = stats
+            self.condition.notify_all()
+
+    def wait_finished(self):
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.finished) == self.trainers)
+            return [self.finished[t] for t in range(self.trainers)]
+
+
+# the shard of this server process, called through rpc
+_shard = None
+
+
+def _pull(ids):
+    return _shard.pull(ids)
+
+
+def _push(version, grads, ids, values):
+    return _shard.push(version, grads, ids, values)
+
+
+def _claim(epoch, batches):
+    return _shard.claim(epoch, batches)
+
+
+def _finish(trainer, stats):
+    _shard.finish(trainer, stats)
+
+
+def _wait_finished():
+    return _shard.wait_finished()
+
+
+def _dropped():
+    return _shard.version, _shard.dropped
+
+
+def pull(model, ids, servers):
+    # copy the dense parameters and the given embedding rows into the
+    # local model and return the version of every shard
+    bounds = row_bounds(model.n_vocab, servers)
+    params = dict(model.named_parameters())
+    futures = []
+    for s in range(servers):
+        owned = ids[(ids >= bounds[s]) & (ids < bounds[s + 1])]
+        futures.append((owned, rpc.rpc_async('ps{}'.format(s), _pull, args=(owned,))))
+    versions = []
+    with torch.no_grad():
+        for owned, future in futures:
+            version, dense, rows = future.wait()
+            for name, value in dense.items():
+                params[name].copy_(value)
+            model.word_embeddings.weight[owned] = rows
+            versions.append(version)
+    return versions
+
+
+def push(model, versions, placement, servers):
+    # send every gradient to its server, returns the number applied
+    bounds = row_bounds(model.n_vocab, servers)
+    grad = model.word_embeddings.weight.grad.coalesce()
+    ids, values = grad.indices()[0], grad.values()
+    dense = [{} for _ in range(servers)]
+    for name, p in model.named_parameters():
+        if name != EMBEDDING and p.grad is not None:
+            dense[placement[name]][name] = p.grad
+    futures = []
+    for s in range(servers):
+        owned = (ids >= bounds[s]) & (ids < bounds[s + 1])
+        futures.append(rpc.rpc_async('ps{}'.format(s), _push,
+                                     args=(versions[s], dense[s], ids[owned], values[owned])))
+    return sum(future.wait() for future in futures)
+
+
+def train_worker(trainer, train_set, test_set, args):
+    servers = args.servers
+    model = RNN(args.n_vocab, args.sequence, sparse=True)
+    if args.straggler:
+        straggler, factor = args.straggler.split(':')
+        if int(straggler) == trainer:
+            slow_down(model, float(factor))
+    placement = place_dense(model, servers)
+    loss_fn = nn.BCEWithLogitsLoss(pos_weight=torch.FloatTensor([5]))
+    batches = len(train_set)//args.batch
+    stats = []
+    for epoch in range(1, args.epochs + 1):
+        order = hogwild_indices(len(train_set), 0, 1, epoch, args.seed)
+        epoch_stats = {'start': time.time(), 'samples': 0, 'loss': 0., 'correct': 0,
+                       'pushes': 0, 'applied': 0}
+        model.train()
+        while True:
+            k = rpc.rpc_sync('ps0', _claim, args=(epoch, batches))
+            if k < 0:
+                break
+            text, label = default_collate(
+                [train_set[i] for i in order[k*args.batch:(k + 1)*args.batch]])
+            versions = pull(model, text.unique(), servers)
+            model.zero_grad()
+            output = model(text)
+            loss = loss_fn(output, label.float())
+            loss.backward()
+            epoch_stats['applied'] += push(model, versions, placement, servers)
+            epoch_stats['pushes'] += servers
+            epoch_stats['samples'] += text.size(0)
+            epoch_stats['loss'] += loss.item()*text.size(0)
+            epoch_stats['correct'] += torch.sigmoid(output).round().long().eq(label).sum().item()
+        epoch_stats['end'] = time.time()
+        stats.append(epoch_stats)
+        print("Trainer {} Epoch: {}/{}, {} samples, {:.1f} samples/s".format(
+            trainer, epoch, args.epochs, epoch_stats['samples'],
+            epoch_stats['samples']/(epoch_stats['end'] - epoch_stats['start'])))
+    rpc.rpc_sync('ps0', _finish, args=(trainer, stats))
+    if trainer != 0:
+        return None
+    # evaluate the final model once every trainer pushed its last update
+    stats = rpc.rpc_sync('ps0', _wait_finished, timeout=0)
+    pull(model, torch.arange(args.n_vocab), servers)
+    test_loss, test_acc = evaluate(model, test_set, args.batch)
+    dropped = sum(rpc.rpc_sync('ps{}'.format(s), _dropped)[1] for s in range(servers))
+    history = []
+    for epoch in range(args.epochs):
+        epochs = [trainer_stats[epoch] for trainer_stats in stats]
+        samples = sum(e['samples'] for e in epochs)
+        train_time = max(e['end'] for e in epochs) - min(e['start'] for e in epochs)
+        history.append({
+            'epoch': epoch + 1,
+            'train_time': train_time,
+            'throughput': samples/train_time,
+            'samples': [e['samples'] for e in epochs],
+            'train_loss': sum(e['loss'] for e in epochs)/samples,
+            'train_acc': sum(e['correct'] for e in epochs)/samples,
+            'test_loss': None,
+            'test_acc': None,
+        })
+        print("Epoch: {}/{}, {:.1f} samples/s, samples per trainer: {}, train loss: {:.6f}".format(
+            epoch + 1, args.epochs, history[-1]['throughput'], history[-1]['samples'],
+            history[-1]['train_loss']))
+    history[-1]['test_loss'] = test_loss.average
+    history[-1]['test_acc'] = test_acc.accuracy
+    history[-1]['dropped'] = dropped
+    print("Dropped stale gradients:", dropped)
+    print("test loss: {}, test acc: {}".format(test_loss, test_acc))
+    return history
+
+
+def _run_process(rank, train_set, test_set, args, queue):
+    global _shard
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(args.port)
+    torch.manual_seed(args.seed)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    world_size = args.servers + args.procs
+    if rank < args.servers:
+        # the shard is ready before any trainer can reach it
+        _shard = ParameterShard(RNN(args.n_vocab, args.sequence), rank, args.servers,
+                                args.lr, args.procs, args.staleness)
+        rpc.init_rpc('ps{}'.format(rank), rank=rank, world_size=world_size)
+        rpc.shutdown()
+        return
+    trainer = rank - args.servers
+    rpc.init_rpc('trainer{}'.format(trainer), rank=rank, world_size=world_size)
+    with open(os.devnull, 'w') as devnull:
+        with redirect_stdout(devnull) if args.quiet else nullcontext():
+            history = train_worker(trainer, train_set, test_set, args)
+    rpc.shutdown()
+    if trainer == 0:
+        queue.put(history)
+
+
+def run(train_set, test_set, args):
+    # train with args.servers servers and args.procs trainers, returns
+    # one dict per epoch, only the last one holds the test results
+    ctx = mp.get_context('spawn')
+    queue = ctx.SimpleQueue()
+    mp.spawn(_run_process, args=(train_set, test_set, args, queue),
+             nprocs=args.servers + args.procs)
+    return queue.get()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", type=str, default='data.h5')
+    parser.add_argument("--synthetic", type=int, default=0)
+    parser.add_argument("--procs", type=int, default=2, help="trainer processes")
+    parser.add_argument("--servers", type=int, default=1)
+    parser.add_argument("--staleness", type=int, default=8,
+                        help="shard versions a gradient may lag behind")
+    parser.add_argument("--straggler", type=str, default=None,
+                        help="trainer:factor, slow the forward pass of one trainer down")
+    parser.add_argument("--threads", type=int, default=1, help="intra-op threads per process")
+    parser.add_argument("--batch", type=int, default=32)
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--lr", type=float, default=0.05)
+    parser.add_argument("--n_vocab", type=int, default=10000)
+    parser.add_argument("--sequence", type=str, default='padded',
+                        choices=['padded', 'packed', 'trimmed'])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=29650)
+    parser.add_argument("--quiet", action='store_true', help="hide the training logs")
+    args = parser.parse_args()
+
+    train_set, test_set = get_datasets(args.dir, args.synthetic)
+    run(train_set, test_set, args)
@@ -0,0 +1,166 @@
+"""
+Phase timing for Trainer.train
+
+PhaseTimer splits every training step into named phases:
+
+    load, h2d, forward, loss, backward, allreduce_wait, optimizer, metrics
+
+and always keeps their totals per epoch, which is all the dynamic split
+needs and costs two perf_counter calls per phase. With enabled=True it
+also synchronizes the device around every phase so the times belong to
+the phase and not to whatever ran before, keeps every span for per-step
+percentiles, and exports them as JSON lines (one line per step) and as a
+Chrome trace per epoch for chrome://tracing or Perfetto.
+
+The allreduce DistributedDataParallel overlaps with the backward pass is
+timed with a communication hook: the part of the backward pass after the
+last bucket was launched is reported as allreduce_wait. An optional
+torch.profiler window captures a few steps in full detail.
+"""
+
+import os
+import json
+import time
+import numpy as np
+import torch
+import torch.distributed as dist
+
+PHASES = ['load', 'h2d', 'forward', 'loss', 'backward', 'allreduce_wait', 'optimizer', 'metrics']
+
+
+class _Span(object):
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.timer.synchronize()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.synchronize()
+        self.timer.record(self.name, self.start, time.perf_counter())
+
+
+class PhaseTimer(object):
+    def __init__(self, enabled=False, device=None, rank=0, profile_steps=None, profile_dir=None):
+        self.enabled = enabled
+        self.sync = enabled and device is not None and device.type == 'cuda'
+        self.device = device
+        self.rank = rank
+        self.totals = dict.fromkeys(PHASES, 0.)
+        self.epoch = 0
+        self.step = 0
+        # per step phase times and the raw spans of this epoch, only when enabled
+        self.steps = []
+        self.current = {}
+        self.spans = []
+        self.origin = time.perf_counter()
+        # start times of the allreduce of every bucket in this step
+        self.comm_launches = []
+        # (first step, steps) captured with torch.profiler
+        self.profile_steps = profile_steps
+        self.profile_dir = profile_dir
+        self.profiler = None
+        self.exported = False
+
+    def synchronize(self):
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+
+    def span(self, name):
+        return _Span(self, name)
+
+    def record(self, name, start, end):
+        if name == 'backward' and self.comm_launches:
+            # the tail of the backward pass after the last bucket
+            # went out is waiting for the allreduce
+            wait_start = min(max(self.comm_launches[-1], start), end)
+            self.comm_launches = []
+            self.record('allreduce_wait', wait_start, end)
+            end = wait_start
+        self.totals[name] += end - start
+        if self.enabled:
+            self.current[name] = self.current.get(name, 0.) + end - start
+            self.spans.append((name, start, end, self.step))
+
+    def start_epoch(self, epoch):
+        self.epoch = epoch
+        self.totals = dict.fromkeys(PHASES, 0.)
+        self.steps = []
+        self.spans = []
+
+    def step_done(self):
+        if self.enabled:
+            self.steps.append(dict(self.current, epoch=self.epoch, step=self.step))
+            self.current = {}
+        self.step += 1
+        if self.profile_steps is not None:
+            self._profile_step()
+
+    def _profile_step(self):
+        first, count = self.profile_steps
+        if self.profiler is None and self.step == first:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.device is not None and self.device.type == 'cuda':
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(
+                activities=activities, record_shapes=True,
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(
+                    self.profile_dir or '.', worker_name='rank{}'.format(self.rank)))
+            self.profiler.start()
+        elif self.profiler is not None and self.step == first + count:
+            self.profiler.stop()
+            self.profile_steps = None
+
+    def percentiles(self, qs=(50, 95, 99)):
+        # per phase, the percentiles of its time per step in seconds
+        result = {}
+        for name in PHASES:
+            values = [s[name] for s in self.steps if name in s]
+            if values:
+                result[name] = np.percentile(values, qs).tolist()
+        return result
+
+    def summary(self):
+        return ' '.join('{} {:.3f}s'.format(name, self.totals[name]) for name in PHASES)
+
+    def report(self):
+        lines = ['{:>15} {:>9} {:>9} {:>9}'.format('phase (ms)', 'p50', 'p95', 'p99')]
+        for name, values in self.percentiles().items():
+            lines.append('{:>15} {:>9.3f} {:>9.3f} {:>9.3f}'.format(
+                name, *[v*1000 for v in values]))
+        return '\n'.join(lines)
+
+    def export_jsonl(self, path):
+        # every epoch adds its steps to the file of the run
+        with open(path, 'a' if self.exported else 'w') as f:
+            for step in self.steps:
+                f.write(json.dumps(dict(step, rank=self.rank)) + '\n')
+
+    def export_chrome_trace(self, path):
+        events = [{'name': name, 'ph': 'X', 'pid': self.rank, 'tid': 0,
+                   'ts': (start - self.origin)*1e6, 'dur': (end - start)*1e6,
+                   'args': {'step': step}}
+                  for name, start, end, step in self.spans]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def export(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.export_jsonl(os.path.join(directory, 'phases_rank{}.jsonl'.format(self.rank)))
+        self.export_chrome_trace(os.path.join(directory, 'trace_rank{}_epoch{}.json'.format(
+            self.rank, self.epoch)))
+        self.exported = True
+
+
+def timing_hook(timer, bucket):
+    # plain averaging allreduce that notes when every bucket goes out
+    timer.comm_launches.append(time.perf_counter())
+    buffer = bucket.buffer()
+    buffer.div_(dist.get_world_size())
+    future = dist.all_reduce(buffer, async_op=True).get_future()
+    return future.then(lambda future: future.value()[0])
@@ -1,5 +1,6 @@
 #!/usr/bin/python
 
+import os
 import sys
 import json
 import h5py
@@ -12,7 +13,8 @@ truncate or pad each sentence to make it a pre-specified fixed length (100),
 remove duplicates and keep the mode of ratings and map ratings to binary sentiment indicator.
 '''
 
-with open('vocab_10000.json') as f:
+# next to this file, which is the working directory under hadoop streaming
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vocab_10000.json')) as f:
     vocab_dict = json.load(f)
     f.close()
 
@@ -29,41 +31,42 @@ def tokenize(text, text_size = 100):
         result.append(1)
     return result
 
-h5file = h5py.File("result_14000.h5", "w")
-for word in vocab_dict.keys():
-    num = np.array(vocab_dict[word])
-    dset = h5file.create_dataset(word, num.shape, dtype=num.dtype, data = num)
-    #dset[word] = num
+if __name__ == '__main__':
+    h5file = h5py.File("result_14000.h5", "w")
+    for word in vocab_dict.keys():
+        num = np.array(vocab_dict[word])
+        dset = h5file.create_dataset(word, num.shape, dtype=num.dtype, data = num)
+        #dset[word] = num
 
 
-review_id = 0
-prev_text = None
-scores = []
+    review_id = 0
+    prev_text = None
+    scores = []
 
-for line in sys.stdin:
-    try:
-        text, score = line.split( '\t' )
+    for line in sys.stdin:
+        try:
+            text, score = line.split( '\t' )
         
-        if text!=prev_text:
-            if prev_text is not None:
-                top_scores = Counter(scores).most_common(5)
-                top_scores.sort()
-                output = tokenize(prev_text)
-                output.append(int(top_scores[0][0]))
-                output = np.array(output)
-                dset = h5file.create_dataset(str(review_id),output.shape,output.dtype,data = output)
-                review_id += 1
-            prev_text = text
-            scores = []
-        scores.append(score[:-1])
-    except ValueError: pass
+            if text!=prev_text:
+                if prev_text is not None:
+                    top_scores = Counter(scores).most_common(5)
+                    top_scores.sort()
+                    output = tokenize(prev_text)
+                    output.append(int(top_scores[0][0]))
+                    output = np.array(output)
+                    dset = h5file.create_dataset(str(review_id),output.shape,output.dtype,data = output)
+                    review_id += 1
+                prev_text = text
+                scores = []
+            scores.append(score[:-1])
+        except ValueError: pass
 
-top_scores = Counter(scores).most_common(5)
-top_scores.sort()
-output = tokenize(prev_text)
-output.append(int(top_scores[0][0]))
-output = np.array(output)
-dset = h5file.create_dataset(str(review_id),output.shape,output.dtype,data = output)
-review_id += 1
+    top_scores = Counter(scores).most_common(5)
+    top_scores.sort()
+    output = tokenize(prev_text)
+    output.append(int(top_scores[0][0]))
+    output = np.array(output)
+    dset = h5file.create_dataset(str(review_id),output.shape,output.dtype,data = output)
+    review_id += 1
 
-h5file.close()
+    h5file.close()
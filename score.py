@@ -0,0 +1,200 @@
+"""
+Batch scoring of raw reviews with a trained checkpoint
+
+Reads one review JSON per line, as in the raw dataset mapper.py reads,
+normalizes and tokenizes it with mapper.process_text and reducer.tokenize in
+a thread or process pool, and runs the model of a checkpoint written with
+dynamic_rnn.py --checkpoint, or exported with export_model.py, on batches
+of up to --batch reviews. A batch goes out when it is full or when its
+first review has waited --timeout_ms, so a slow trickle of input is still
+answered quickly. One prediction per input
+line is written as JSONL, in input order:
+
+    {"line": 0, "reviewerID": "...", "asin": "...", "label": 1, "probability": 0.93}
+
+Reviews with no words left after normalization are not scored, as the
+mapper drops them, and get "label": null. A line that is no review JSON
+with a text gets its error instead, {"line": 3, "error": "..."}, and the
+rest are scored all the same.
+
+    python score.py --checkpoint run.pt --input reviews.json --output predictions.jsonl
+    zcat reviews.json.gz | python score.py --checkpoint run.pt --pool process --workers 4
+
+The throughput and the latency percentiles from reading a review to
+writing its prediction are printed to stderr at the end.
+"""
+
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+import torch
+from mapper import process_text
+from reducer import tokenize
+from models import load_model, predict
+
+# 2: unknown, as in reducer.tokenize
+UNKNOWN = 2
+# fields copied from the review to its prediction
+KEYS = ['reviewerID', 'asin']
+
+
+def prepare(line, n_vocab, text_size=100):
+    # the keys of a raw review and its word ids, None if no word is left
+    review = json.loads(line)
+    keys = {key: review[key] for key in KEYS if key in review}
+    text = review.get('reviewText', '')
+    if not isinstance(text, str):
+        raise TypeError("reviewText is {}, not a string".format(type(text).__name__))
+    text = process_text(text)
+    if text == '':
+        return keys, None
+    # the vocabulary may hold more words than the model embeds
+    return keys, [i if i < n_vocab else UNKNOWN for i in tokenize(text, text_size)]
+
+
+def read(lines, executor, pending, n_vocab, failure):
+    # hand every line to the pool as it is read, None marks the end, also
+    # when reading or submitting fails, which failure keeps for run to raise
+    try:
+        for number, line in enumerate(lines):
+            if line.strip():
+                pending.put((number, time.perf_counter(), executor.submit(prepare, line, n_vocab)))
+    except BaseException as e:
+        failure.append(e)
+    finally:
+        pending.put(None)
+
+
+def batches(pending, batch_size, timeout):
+    # up to batch_size reviews, fewer once the first one waited timeout
+    done = False
+    while not done:
+        item = pending.get()
+        if item is None:
+            return
+        batch = [item]
+        deadline = item[1] + timeout
+        while len(batch) < batch_size:
+            try:
+                item = pending.get(timeout=max(deadline - time.perf_counter(), 0))
+            except queue.Empty:
+                break
+            if item is None:
+                done = True
+                break
+            batch.append(item)
+        yield batch
+
+
+class Scorer(object):
+    def __init__(self, model, device, output, classes=2):
+        self.model = model
+        self.device = device
+        self.output = output
+        self.classes = classes
+        self.latencies = []
+        self.scored = 0
+        self.batches = 0
+        self.errors = 0
+
+    def prepared(self, future):
+        # the keys and word ids of a line, or its error in place of the keys
+        try:
+            return future.result()
+        except Exception as e:
+            self.errors += 1
+            return {'error': '{}: {}'.format(type(e).__name__, e)}, None
+
+    def score(self, batch):
+        prepared = [(number, start, self.prepared(future)) for number, start, future in batch]
+        texts = [ids for _, _, (_, ids) in prepared if ids is not None]
+        labels, probabilities = [], []
+        if texts:
+            with torch.inference_mode():
+                output = self.model(torch.tensor(texts, device=self.device))
+                labels = predict(output).view(-1).tolist()
+                if self.classes == 2:
+                    probabilities = torch.sigmoid(output).view(-1).tolist()
+                else:
+                    probabilities = torch.softmax(output, 1).tolist()
+            self.scored += len(texts)
+            self.batches += 1
+        k = 0
+        for number, start, (keys, ids) in prepared:
+            record = dict(line=number, **keys)
+            if ids is None:
+                # the error of a failed line stands in for its label
+                if 'error' not in keys:
+                    record['label'] = None
+            else:
+                label, probability = labels[k], probabilities[k]
+                k += 1
+                if self.classes == 2:
+                    record.update(label=label, probability=probability)
+                else:
+                    # the class index is the star rating from 0
+                    record.update(label=label + 1, probabilities=probability)
+            self.output.write(json.dumps(record) + '\n')
+        end = time.perf_counter()
+        self.latencies += [end - start for _, start, _ in prepared]
+
+
+def run(lines, model, output, args):
+    device = torch.device(args.device)
+    executor = (ProcessPoolExecutor if args.pool == 'process' else ThreadPoolExecutor)(args.workers)
+    pending = queue.Queue(maxsize=args.queue)
+    failure = []
+    reader = threading.Thread(target=read, args=(lines, executor, pending, model.n_vocab, failure),
+                              daemon=True)
+    scorer = Scorer(model, device, output, model.classes)
+    start = time.perf_counter()
+    reader.start()
+    for batch in batches(pending, args.batch, args.timeout_ms/1000.):
+        scorer.score(batch)
+    elapsed = time.perf_counter() - start
+    reader.join()
+    executor.shutdown()
+    if failure:
+        raise failure[0]
+    return scorer, elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint", type=str, required=True)
+    parser.add_argument("--input", type=str, default='-', help="review JSON lines, - for stdin")
+    parser.add_argument("--output", type=str, default='-', help="prediction JSON lines, - for stdout")
+    parser.add_argument("--batch", type=int, default=64, help="most reviews per forward pass")
+    parser.add_argument("--timeout_ms", type=float, default=20.,
+                        help="longest a review waits for its batch to fill up")
+    parser.add_argument("--pool", type=str, default='thread', choices=['thread', 'process'],
+                        help="where reviews are normalized and tokenized")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--queue", type=int, default=1024, help="reviews read ahead of the model")
+    parser.add_argument("--device", type=str, default='cpu', choices=['cuda', 'cpu'])
+    parser.add_argument("--threads", type=int, default=0, help="intra-op threads, 0 for the default")
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    model = load_model(args.checkpoint, torch.device(args.device))
+    lines = sys.stdin if args.input == '-' else open(args.input)
+    output = sys.stdout if args.output == '-' else open(args.output, 'w')
+    scorer, elapsed = run(lines, model, output, args)
+    if output is not sys.stdout:
+        output.close()
+
+    latencies = np.array(scorer.latencies)*1000
+    print("Scored {} of {} reviews in {} batches, {:.3f}s, {:.1f} reviews/s".format(
+        scorer.scored, len(latencies), scorer.batches, elapsed, len(latencies)/elapsed),
+        file=sys.stderr)
+    if scorer.errors:
+        print("{} lines failed, see their \"error\"".format(scorer.errors), file=sys.stderr)
+    if len(latencies):
+        print("Latency p50 {:.2f}ms p95 {:.2f}ms p99 {:.2f}ms".format(
+            *np.percentile(latencies, [50, 95, 99])), file=sys.stderr)
@@ -0,0 +1,252 @@
+"""
+Online sentiment scoring over HTTP with micro-batching
+
+A small asyncio HTTP/1.1 server, keep-alive included, around a checkpoint
+of dynamic_rnn.py or an export of export_model.py:
+
+    python serve.py --checkpoint rnn_int8.pt --port 8080 --batch 32 --max_wait_ms 5
+    curl -d '{"reviewText": "Works great, would buy again"}' localhost:8080/score
+    curl localhost:8080/metrics
+
+Concurrent requests are coalesced: a micro-batch is sent to the model as
+soon as it holds --batch reviews or its oldest review has waited
+--max_wait_ms. Normalization, tokenization and the forward pass of a batch
+run in a thread or process pool, with at most --workers batches in flight;
+the others wait in the queue, whose depth /metrics reports along with the
+batch sizes and the latency percentiles of the last --window requests.
+
+loadgen.py measures throughput and latency against it.
+"""
+
+import json
+import time
+import asyncio
+import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+import torch
+from mapper import process_text
+from reducer import tokenize
+from models import load_model, predict
+from score import UNKNOWN
+
+# the model of this worker process, or of all worker threads
+_model = None
+
+
+def _init_worker(path, threads):
+    global _model
+    if threads > 0:
+        torch.set_num_threads(threads)
+    _model = load_model(path, torch.device('cpu'))
+
+
+def score_batch(texts):
+    # label and probability, or class probabilities, of every raw review
+    # text, None for the ones with no word left after normalization
+    ids = []
+    results = [None]*len(texts)
+    for k, text in enumerate(texts):
+        # a review that fails only fails itself, not its micro-batch
+        try:
+            words = process_text(text)
+            ids.append([i if i < _model.n_vocab else UNKNOWN for i in tokenize(words)] if words else None)
+        except Exception as e:
+            ids.append(None)
+            results[k] = {'error': '{}: {}'.format(type(e).__name__, e)}
+    scored = [k for k, words in enumerate(ids) if words is not None]
+    if not scored:
+        return results
+    with torch.inference_mode():
+        output = _model(torch.tensor([ids[k] for k in scored]))
+        labels = predict(output).view(-1).tolist()
+        if _model.classes == 2:
+            probabilities = torch.sigmoid(output).view(-1).tolist()
+        else:
+            probabilities = torch.softmax(output, 1).tolist()
+    for k, label, probability in zip(scored, labels, probabilities):
+        if _model.classes == 2:
+            results[k] = {'label': label, 'probability': probability}
+        else:
+            results[k] = {'label': label + 1, 'probabilities': probability}
+    return results
+
+
+class Metrics(object):
+    def __init__(self, window=10000):
+        self.requests = 0
+        self.batches = 0
+        self.batch_sizes = collections.Counter()
+        self.max_queue_depth = 0
+        self.latencies = collections.deque(maxlen=window)
+        self.start = time.time()
+
+    def snapshot(self, queue_depth, in_flight):
+        latencies = np.array(self.latencies)*1000
+        percentiles = np.percentile(latencies, [50, 95, 99]).tolist() if len(latencies) else [None]*3
+        return {
+            'uptime': time.time() - self.start,
+            'requests': self.requests,
+            'batches': self.batches,
+            'mean_batch': self.requests/self.batches if self.batches else None,
+            'batch_sizes': dict(sorted(self.batch_sizes.items())),
+            'queue_depth': queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'batches_in_flight': in_flight,
+            'latency_ms': dict(zip(['p50', 'p95', 'p99'], percentiles)),
+        }
+
+
+class MicroBatcher(object):
+    def __init__(self, executor, workers, batch_size, max_wait, metrics):
+        self.executor = executor
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.metrics = metrics
+        self.queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(workers)
+        self.in_flight = 0
+        # asyncio only keeps weak references to running tasks
+        self.tasks = set()
+
+    async def score(self, text):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, future, time.perf_counter()))
+        self.metrics.max_queue_depth = max(self.metrics.max_queue_depth, self.queue.qsize())
+        return await future
+
+    def start(self):
+        self.tasks.add(asyncio.get_running_loop().create_task(self.run()))
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # a batch only forms once a worker is free to take it,
+            # so requests keep coalescing while all of them are busy
+            await self.slots.acquire()
+            batch = [await self.queue.get()]
+            deadline = batch[0][2] + self.max_wait
+            while len(batch) < self.batch_size:
+                # whatever queued up joins at once, otherwise
+                # wait for more until the deadline
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.in_flight += 1
+            task = loop.create_task(self.dispatch(loop, batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def dispatch(self, loop, batch):
+        try:
+            results = await loop.run_in_executor(self.executor, score_batch, [text for text, _, _ in batch])
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self.in_flight -= 1
+            self.slots.release()
+        end = time.perf_counter()
+        self.metrics.requests += len(batch)
+        self.metrics.batches += 1
+        self.metrics.batch_sizes[len(batch)] += 1
+        self.metrics.latencies.extend(end - start for _, _, start in batch)
+
+
+def respond(writer, status, body):
+    payload = json.dumps(body).encode()
+    writer.write('HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(
+        status, len(payload)).encode() + payload)
+
+
+async def handle(reader, writer, batcher, metrics):
+    # one connection, any number of requests while it is kept alive
+    try:
+        while True:
+            request = await reader.readline()
+            if not request:
+                break
+            method, path, _ = request.decode().split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, value = line.decode().split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            if method == 'POST' and path == '/score':
+                try:
+                    text = json.loads(body)['reviewText']
+                except (ValueError, KeyError, TypeError):
+                    text = None
+                if not isinstance(text, str):
+                    respond(writer, '400 Bad Request', {'error': 'expected {"reviewText": "..."}'})
+                else:
+                    try:
+                        result = await batcher.score(text)
+                    except Exception as e:
+                        # the forward pass of the whole micro-batch failed
+                        result = {'error': '{}: {}'.format(type(e).__name__, e)}
+                    if result is not None and 'error' in result:
+                        respond(writer, '500 Internal Server Error', result)
+                    else:
+                        respond(writer, '200 OK', result if result is not None else {'label': None})
+            elif method == 'GET' and path == '/metrics':
+                respond(writer, '200 OK', metrics.snapshot(batcher.queue.qsize(), batcher.in_flight))
+            else:
+                respond(writer, '404 Not Found', {'error': path})
+            await writer.drain()
+            if headers.get('connection', '').lower() == 'close':
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(args):
+    if args.pool == 'process':
+        executor = ProcessPoolExecutor(args.workers, initializer=_init_worker,
+                                       initargs=(args.checkpoint, args.threads))
+    else:
+        # the threads share one model, torch releases the GIL in its kernels
+        _init_worker(args.checkpoint, args.threads)
+        executor = ThreadPoolExecutor(args.workers)
+    metrics = Metrics(args.window)
+    batcher = MicroBatcher(executor, args.workers, args.batch, args.max_wait_ms/1000., metrics)
+    batcher.start()
+    server = await asyncio.start_server(lambda r, w: handle(r, w, batcher, metrics),
+                                        args.host, args.port, backlog=1024)
+    print("Serving on {}:{} with {} {} workers".format(args.host, args.port, args.workers, args.pool),
+          flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint", type=str, required=True)
+    parser.add_argument("--host", type=str, default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--batch", type=int, default=32, help="most requests per micro-batch")
+    parser.add_argument("--max_wait_ms", type=float, default=5.,
+                        help="longest a request waits for its micro-batch to fill up")
+    parser.add_argument("--pool", type=str, default='thread', choices=['thread', 'process'])
+    parser.add_argument("--workers", type=int, default=1, help="micro-batches scored at once")
+    parser.add_argument("--threads", type=int, default=1, help="intra-op threads per worker")
+    parser.add_argument("--window", type=int, default=10000, help="requests in the latency percentiles")
+    args = parser.parse_args()
+    asyncio.run(serve(args))
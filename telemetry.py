@@ -0,0 +1,126 @@
+"""
+Cluster throughput and straggler telemetry
+
+Every `every` steps the ranks all-gather what they did since the last
+report: samples, steps, wall time, compute time (the forward time the
+dynamic split balances) and the time spent waiting for the data loader. Rank 0 appends one line per report to a JSONL file:
+
+    {"time": ..., "epoch": 2, "step": 150, "samples_per_s": 1180.4,
+     "ranks": [{"samples_per_s": ..., "compute_ms": ..., "load_ms": ...,
+                "score": 1.0, "flagged": false, "excluded": false}, ...]}
+
+A rank whose compute rate stays more than `threshold` times below the
+median for `patience` reports in a row is flagged as a straggler. While any
+rank is flagged the dynamic split at the end of the epoch is computed from
+the most recent report instead of the epoch average, so a slowdown that
+started mid-epoch is fully accounted for. A flagged rank more than
+`exclude` times slower is cut down to a single sample per step for the
+rest of the run, as far as a rank can be excluded without leaving the
+process group.
+
+All ranks see the same gathered numbers and so make the same decisions.
+"""
+
+import json
+import time
+import numpy as np
+import torch
+import torch.distributed as dist
+from dynamic_dataloader import collective_device
+
+
+class Telemetry(object):
+    def __init__(self, path=None, every=50, threshold=1.5, patience=3, exclude=0.):
+        self.path = path
+        self.every = every
+        self.threshold = threshold
+        self.patience = patience
+        # slowdown past which a straggler is excluded, 0 never excludes
+        self.exclude = exclude
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+        self.strikes = np.zeros(self.world_size, dtype=int)
+        self.flagged = np.zeros(self.world_size, dtype=bool)
+        self.excluded = np.zeros(self.world_size, dtype=bool)
+        # compute seconds per sample of every rank in the last report
+        self.recent_cost = None
+        self.epoch = 0
+        self.steps = 0
+
+    def start_epoch(self, epoch, phases):
+        self.epoch = epoch
+        self.mark(phases)
+
+    def mark(self, phases):
+        self.window_start = time.time()
+        self.window_totals = dict(phases.totals)
+        self.window_samples = 0
+        self.window_steps = 0
+
+    def step(self, phases, samples):
+        self.window_samples += samples
+        self.window_steps += 1
+        self.steps += 1
+        if self.window_steps == self.every:
+            self.report(phases)
+
+    def report(self, phases):
+        def delta(name):
+            return phases.totals[name] - self.window_totals.get(name, 0.)
+        row = [self.window_samples, self.window_steps, time.time() - self.window_start,
+               delta('forward'), delta('load')]
+        device = collective_device()
+        rows = [torch.zeros(len(row), dtype=torch.float64, device=device)
+                for _ in range(self.world_size)]
+        dist.all_gather(rows, torch.tensor(row, dtype=torch.float64, device=device))
+        samples, steps, wall, compute, load = torch.stack(rows).cpu().numpy().T
+
+        rate = samples/np.maximum(compute, 1e-9)
+        score = np.median(rate)/np.maximum(rate, 1e-9)
+        self.strikes = np.where(score > self.threshold, self.strikes + 1, 0)
+        self.flagged = self.strikes >= self.patience
+        if self.exclude > 0:
+            # one sample per step costs more per sample than a full
+            # batch, so an excluded rank is never measured fast again
+            self.excluded |= self.flagged & (score > self.exclude)
+        self.recent_cost = compute/np.maximum(samples, 1)
+
+        if self.rank == 0 and self.path:
+            line = {
+                'time': time.time(),
+                'epoch': self.epoch,
+                'step': self.steps,
+                'samples_per_s': samples.sum()/wall.max(),
+                'ranks': [{
+                    'samples_per_s': samples[r]/wall[r],
+                    'compute_ms': 1000.*compute[r]/steps[r],
+                    'load_ms': 1000.*load[r]/steps[r],
+                    'score': score[r],
+                    'flagged': bool(self.flagged[r]),
+                    'excluded': bool(self.excluded[r]),
+                } for r in range(self.world_size)],
+            }
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(line) + '\n')
+        if self.flagged.any():
+            print("Stragglers", np.flatnonzero(self.flagged).tolist(),
+                  "scores", np.round(score, 2).tolist())
+        self.mark(phases)
+
+    def split_time(self, forward_time, samples):
+        # the time the dynamic split balances on: the epoch's own while
+        # nobody straggles, the most recent speed times the epoch's
+        # samples once a straggler is flagged
+        if self.recent_cost is None or not self.flagged.any():
+            return forward_time
+        return self.recent_cost[self.rank]*samples
+
+    def exclude_policy(self, policy):
+        # the split of policy with the excluded ranks pinned
+        # to one sample per step
+        def split(sampler, time_arr, total_batch):
+            sampler.pinned = self.excluded.copy() if self.excluded.any() else None
+            if sampler.pinned is not None:
+                print("Excluded ranks", np.flatnonzero(self.excluded).tolist())
+            return policy(sampler, time_arr, total_batch)
+        return split
@@ -0,0 +1,143 @@
+"""
+Work-stealing sampling as an alternative to the static per-rank splits of
+DynamicDistributedSampler
+
+Every rank walks the same shuffled permutation of the epoch but claims it in
+small chunks through an atomic counter in a torch.distributed TCPStore, so
+fast ranks take more chunks than slow ones and the epoch ends when the pool
+is empty. Ranks finish with different numbers of steps, so the training loop
+has to run inside DistributedDataParallel.join().
+
+Note that DistributedDataParallel still synchronizes every step, so under it
+the ranks claim about the same number of chunks and stealing mostly saves the
+samples the static split drops. The full benefit shows when ranks don't wait
+for each other at every step.
+
+Standalone check with gloo processes on one machine, rank r being r+1 times
+slower than rank 0, with and without a per-step allreduce:
+
+    python work_stealing.py --world_size 4 --delay 1
+    python work_stealing.py --world_size 4 --delay 1 --ddp
+"""
+
+import os
+import time
+import argparse
+from contextlib import nullcontext
+import torch
+import torch.distributed as dist
+from torch.utils.data.sampler import Sampler
+from dynamic_dataloader import collective_device
+
+
+def get_steal_store(rank, world_size, port_offset=1):
+    # the counter lives next to the env:// rendezvous of the process group
+    host = os.environ.get('MASTER_ADDR', '127.0.0.1')
+    port = int(os.environ.get('MASTER_PORT', 29500)) + port_offset
+    return dist.TCPStore(host, port, world_size, rank == 0)
+
+
+class WorkStealingBatchSampler(Sampler):
+
+    def __init__(self, data_source, batch_size, store, rank, world_size, chunk_batches=4, seed=0):
+        self.data_source = data_source
+        self.batch_size = batch_size
+        self.store = store
+        self.rank = rank
+        self.world_size = world_size
+        self.chunk_batches = chunk_batches
+        self.seed = seed
+        self.epoch = 0
+        self.chunks = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        # every rank shuffles the same way, only the cursor is shared
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        total = len(self.data_source)
+        indices = torch.randperm(total, generator=g).tolist()
+        chunk = self.batch_size*self.chunk_batches
+        key = 'steal/{}'.format(self.epoch)
+        self.chunks = 0
+        while True:
+            end = self.store.add(key, chunk)
+            start = end - chunk
+            if start >= total:
+                return
+            self.chunks += 1
+            end = min(end, total)
+            for begin in range(start, end, self.batch_size):
+                yield indices[begin:min(begin + self.batch_size, end)]
+
+    def __len__(self):
+        # expected number of batches if all ranks ran at the same speed
+        return -(-len(self.data_source)//(self.batch_size*self.world_size))
+
+
+def gather_idle_time(idle):
+    # idle is the time a rank spent waiting for the others after its
+    # last step, measured locally so clock skew between nodes doesn't matter
+    world_size = dist.get_world_size()
+    device = collective_device()
+    idle_list = [torch.zeros(1, device=device) for _ in range(world_size)]
+    dist.all_gather(idle_list, torch.tensor([float(idle)], device=device))
+    return [t.item() for t in idle_list]
+
+
+def _demo(rank, world_size, args):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(args.port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    from torch.nn.parallel import DistributedDataParallel
+    model = torch.nn.Linear(16, 1)
+    if args.ddp:
+        model = DistributedDataParallel(model)
+    optimizer = torch.optim.SGD(model.parameters(), 0.01)
+    store = get_steal_store(rank, world_size)
+    sampler = WorkStealingBatchSampler(range(args.data), args.batch, store, rank, world_size,
+                                       chunk_batches=args.chunk)
+    # rank r needs (r+1) times as long per sample as rank 0
+    delay = args.delay*(rank + 1)/1000.
+    for epoch in range(1, args.epochs + 1):
+        sampler.set_epoch(epoch)
+        start = time.time()
+        samples = 0
+        with model.join() if args.ddp else nullcontext():
+            for batch in sampler:
+                time.sleep(delay*len(batch))
+                x = torch.randn(len(batch), 16)
+                loss = model(x).pow(2).mean()
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+                samples += len(batch)
+            finish = time.time()
+        if not args.ddp:
+            dist.barrier()
+        idle = time.time() - finish
+        idle_list = gather_idle_time(idle)
+        counts = [torch.zeros(2) for _ in range(world_size)]
+        dist.all_gather(counts, torch.tensor([float(samples), float(sampler.chunks)]))
+        if rank == 0:
+            print("Epoch {}, time {:.3f}s".format(epoch, time.time() - start))
+            for r in range(world_size):
+                print("  rank {}: {} samples in {} chunks, idle {:.3f}s".format(
+                    r, int(counts[r][0]), int(counts[r][1]), idle_list[r]))
+    dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--world_size", type=int, default=4)
+    parser.add_argument("--data", type=int, default=4096)
+    parser.add_argument("--batch", type=int, default=32)
+    parser.add_argument("--chunk", type=int, default=2, help="batches per claimed chunk")
+    parser.add_argument("--delay", type=float, default=0.5, help="ms per sample on rank 0")
+    parser.add_argument("--epochs", type=int, default=2)
+    parser.add_argument("--ddp", action='store_true', help="allreduce gradients every step")
+    parser.add_argument("--port", type=int, default=29500)
+    args = parser.parse_args()
+    torch.multiprocessing.spawn(_demo, args=(args.world_size, args), nprocs=args.world_size)